@@ -51,6 +51,8 @@ sys.path.insert(0, BlenderExporterDir)
 import osg
 from osg import osgdata
 from osg import osgconf
+from osg import osgwatch
+from osg import osgserver
 
 
 def OpenSceneGraphExport(config=None):
@@ -88,6 +90,54 @@ def main():
                         help="Use quaternions for rotation baking")
     parser.add_argument("-m", "--apply-modifiers", dest="apply_modifiers", action="store_true", default=False,
                         help="Apply modifiers before exporting")
+    parser.add_argument("--split-large-geometries", dest="split_large_geometries", action="store_true",
+                        default=False, help="Split geometries too large for 16 bits indices")
+    parser.add_argument("--chunk-large-meshes", dest="chunk_large_meshes", action="store_true", default=False,
+                        help="Partition large static meshes into chunks that can be culled separately")
+    parser.add_argument("--chunk-triangle-count", dest="chunk_triangle_count", type=int, default=16384,
+                        help="Target triangle count of a mesh chunk")
+    parser.add_argument("--spatial-hierarchy", dest="spatial_hierarchy", action="store_true", default=False,
+                        help="Group top level objects into a bounding volume hierarchy")
+    parser.add_argument("--spatial-leaf-size", dest="spatial_leaf_size", type=int, default=8,
+                        help="Maximum number of objects in a leaf of the spatial hierarchy")
+    parser.add_argument("--static-batching", dest="static_batching", action="store_true", default=False,
+                        help="Merge static objects sharing a material into batched geometries")
+    parser.add_argument("--batch-vertex-budget", dest="batch_vertex_budget", type=int, default=65536,
+                        help="Maximum number of vertices of a batched geometry")
+    parser.add_argument("--optimize-scene-graph", dest="optimize_scene_graph", action="store_true", default=False,
+                        help="Remove identity transforms and empty groups, fold static transforms")
+    parser.add_argument("--flatten-static-transforms", dest="flatten_static_transforms", action="store_true",
+                        default=False, help="Bake static transforms into unshared geometries when optimizing")
+    parser.add_argument("--share-collection-instances", dest="share_collection_instances", action="store_true", default=False,
+                        help="Export each instanced collection once and reference it from every instance")
+    parser.add_argument("--share-object-instances", dest="share_object_instances", action="store_true", default=False,
+                        help="Export vertex, face, particle and geometry nodes instances as references instead of making them real")
+    parser.add_argument("--cache-dir", dest="conversion_cache_dir", type=str, default="",
+                        help="Directory keeping converted geometries between exports")
+    parser.add_argument("--cache-size", dest="conversion_cache_size", type=int, default=512,
+                        help="Maximum size of the conversion cache in megabytes")
+    parser.add_argument("--shard-index", dest="shard_index", type=int, default=0,
+                        help="Index of the part of the scene to export when sharding it")
+    parser.add_argument("--shard-count", dest="shard_count", type=int, default=1,
+                        help="Number of parts the top level objects are split into")
+    parser.add_argument("--bake-to-channels", dest="bake_to_channels", action="store_true", default=False,
+                        help="Write baked transforms directly to animation channels instead of temporary actions")
+    parser.add_argument("--selective-baking", dest="selective_baking", action="store_true", default=False,
+                        help="Only bake the bones whose constraints, drivers or keys differ from their fcurves")
+    parser.add_argument("--euler-to-quaternion", dest="convert_euler_rotations", action="store_true",
+                        default=False, help="Export euler rotation curves as a single quaternion channel")
+    parser.add_argument("--prune-constant-channels", dest="prune_constant_channels", action="store_true",
+                        default=False, help="Remove animation channels holding a constant value")
+    parser.add_argument("--prune-stacked-transforms", dest="prune_stacked_transforms", action="store_true",
+                        default=False, help="Fold the stacked transforms no animation channel targets into a matrix")
+    parser.add_argument("--reduce-keyframes", dest="reduce_keyframes", action="store_true", default=False,
+                        help="Remove the keyframes that linear interpolation reproduces within tolerances")
+    parser.add_argument("--position-tolerance", dest="keyframe_position_tolerance", type=float, default=0.001,
+                        help="Maximum translation error of keyframe reduction")
+    parser.add_argument("--scale-tolerance", dest="keyframe_scale_tolerance", type=float, default=0.001,
+                        help="Maximum scale and morph weight error of keyframe reduction")
+    parser.add_argument("--rotation-tolerance", dest="keyframe_rotation_tolerance", type=float, default=0.1,
+                        help="Maximum rotation error of keyframe reduction in degrees")
     parser.add_argument("-r", "--armature-rest", dest="arm_rest", action="store_true", default=False,
                         help="Export static armature in rest position")
     parser.add_argument("-j", "--json-materials", dest="json_materials", action="store_true", default=False,
@@ -96,10 +146,14 @@ def main():
                         help="Store shader graphs into JSON format")
     parser.add_argument("--use-scene-fps", dest="use_scene_fps", action="store_true", default=False,
                         help="Use current scene FPS")
+    parser.add_argument("--serve", dest="serve_address", metavar='SOCKET|HOST:PORT', default=None,
+                        help="Keep running and export the JSON jobs received on a local socket")
 
     args = parser.parse_args(argv)  # In this example we wont use the args
 
-    if args.save_path is None:
+    if args.serve_address is not None:
+        osgserver.serve(args.serve_address, args.conversion_cache_dir, args.conversion_cache_size)
+    elif args.save_path is None:
         print("\n*** No output filename specified (use -o)")
     else:
         config = osgconf.Config()
@@ -108,6 +162,30 @@ def main():
         config.bake_animations = args.bake_all
         config.use_quaternions = args.use_quaternions
         config.apply_modifiers = args.apply_modifiers
+        config.split_large_geometries = args.split_large_geometries
+        config.chunk_large_meshes = args.chunk_large_meshes
+        config.chunk_triangle_count = args.chunk_triangle_count
+        config.spatial_hierarchy = args.spatial_hierarchy
+        config.spatial_leaf_size = args.spatial_leaf_size
+        config.static_batching = args.static_batching
+        config.batch_vertex_budget = args.batch_vertex_budget
+        config.optimize_scene_graph = args.optimize_scene_graph
+        config.flatten_static_transforms = args.flatten_static_transforms
+        config.share_collection_instances = args.share_collection_instances
+        config.share_object_instances = args.share_object_instances
+        config.conversion_cache_dir = args.conversion_cache_dir
+        config.conversion_cache_size = args.conversion_cache_size
+        config.shard_index = args.shard_index
+        config.shard_count = args.shard_count
+        config.bake_to_channels = args.bake_to_channels
+        config.selective_baking = args.selective_baking
+        config.convert_euler_rotations = args.convert_euler_rotations
+        config.prune_constant_channels = args.prune_constant_channels
+        config.prune_stacked_transforms = args.prune_stacked_transforms
+        config.reduce_keyframes = args.reduce_keyframes
+        config.keyframe_position_tolerance = args.keyframe_position_tolerance
+        config.keyframe_scale_tolerance = args.keyframe_scale_tolerance
+        config.keyframe_rotation_tolerance = args.keyframe_rotation_tolerance
         config.arm_rest = args.arm_rest
         config.scene = bpy.context.scene
         config.json_materials = args.json_materials
@@ -209,6 +287,99 @@ class OSGGUI(bpy.types.Operator, ExportHelper):
         default=True
         )
     
+    SPLIT_GEOMETRIES : BoolProperty(
+        name="Split Large Geometries",
+        description="Split geometries having more than 65536 vertices so they use 16 bits indices",
+        default=False
+        )
+    
+    CHUNK_MESHES : BoolProperty(
+        name="Chunk Large Meshes",
+        description="Partition large static meshes into an octree of chunks that can be culled separately",
+        default=False
+        )
+    
+    CHUNK_TRIANGLES : IntProperty(
+        name="Triangles per Chunk",
+        description="Target triangle count of a mesh chunk",
+        default=16384,
+        min=256,
+        max=1048576
+        )
+    
+    SPATIAL_HIERARCHY : BoolProperty(
+        name="Spatial Hierarchy",
+        description="Group top level static objects into a bounding volume hierarchy to speed up culling",
+        default=False
+        )
+    
+    SPATIAL_LEAF_SIZE : IntProperty(
+        name="Objects per Leaf",
+        description="Maximum number of objects in a leaf group of the spatial hierarchy",
+        default=8,
+        min=2,
+        max=256
+        )
+    
+    STATIC_BATCHING : BoolProperty(
+        name="Static Batching",
+        description="Merge static objects sharing a material into batched geometries",
+        default=False
+        )
+    
+    BATCH_VERTEX_BUDGET : IntProperty(
+        name="Vertices per Batch",
+        description="Maximum number of vertices of a batched geometry",
+        default=65536,
+        min=1024,
+        max=1048576
+        )
+    
+    OPTIMIZE_SCENE_GRAPH : BoolProperty(
+        name="Optimize Scene Graph",
+        description="Remove identity transforms and empty groups, fold chains of static transforms",
+        default=False
+        )
+    
+    FLATTEN_TRANSFORMS : BoolProperty(
+        name="Flatten Static Transforms",
+        description="Bake static transforms into unshared geometries when optimizing the scene graph",
+        default=False
+        )
+    
+    SHARE_COLLECTIONS : BoolProperty(
+        name="Share Collection Instances",
+        description="Export each instanced collection once as a shared group referenced by every instance",
+        default=False
+        )
+    
+    SHARE_INSTANCES : BoolProperty(
+        name="Share Object Instances",
+        description="Export instances generated by vertices, faces, particles and geometry nodes as references to a shared geode instead of making them real",
+        default=False
+        )
+    
+    CACHE_DIR : StringProperty(
+        name="Conversion Cache",
+        description="Directory keeping converted geometries of unchanged meshes between exports, empty to disable",
+        default="",
+        subtype="DIR_PATH"
+        )
+    
+    CACHE_SIZE : IntProperty(
+        name="Conversion Cache Size",
+        description="Maximum size of the conversion cache in megabytes, least recently used entries are removed first",
+        default=512,
+        min=1,
+        max=65536
+        )
+    
+    LIVE_EXPORT : BoolProperty(
+        name="Live Export",
+        description="Export the scene again each time it changes or is saved, only changed meshes are converted again",
+        default=False
+        )
+    
     LOG : BoolProperty(
         name="Write log",
         description="Write log file",
@@ -241,6 +412,65 @@ class OSGGUI(bpy.types.Operator, ExportHelper):
         max=30
         )
     
+    BAKE_TO_CHANNELS : BoolProperty(
+        name="Bake to channels",
+        description="Write baked transforms directly to animation channels instead of temporary actions",
+        default=False
+        )
+    
+    SELECTIVE_BAKING : BoolProperty(
+        name="Selective baking",
+        description="Only bake the bones whose constraints, drivers or keys differ from their fcurves",
+        default=False
+        )
+    
+    EULER_TO_QUATERNION : BoolProperty(
+        name="Euler to quaternion",
+        description="Export euler rotation curves as a single quaternion channel without baking",
+        default=False
+        )
+    
+    PRUNE_CHANNELS : BoolProperty(
+        name="Prune constant channels",
+        description="Remove animation channels holding a constant value, folding it into the default transform",
+        default=False
+        )
+    
+    PRUNE_STACKED : BoolProperty(
+        name="Prune stacked transforms",
+        description="Fold the bone and object transforms no animation channel targets into their bind matrix",
+        default=False
+        )
+    
+    REDUCE_KEYFRAMES : BoolProperty(
+        name="Reduce keyframes",
+        description="Remove the keyframes that linear interpolation reproduces within tolerances",
+        default=False
+        )
+    
+    POSITION_TOLERANCE : FloatProperty(
+        name="Position tolerance",
+        description="Maximum translation error of keyframe reduction",
+        min=0.0, max=1.0,
+        default=0.001,
+        precision=4
+        )
+    
+    SCALE_TOLERANCE : FloatProperty(
+        name="Scale tolerance",
+        description="Maximum scale and morph weight error of keyframe reduction",
+        min=0.0, max=1.0,
+        default=0.001,
+        precision=4
+        )
+    
+    ROTATION_TOLERANCE : FloatProperty(
+        name="Rotation tolerance",
+        description="Maximum rotation error of keyframe reduction in degrees",
+        min=0.0, max=10.0,
+        default=0.1
+        )
+    
     ARMATURE_REST : BoolProperty(
         name="Force REST pose",
         description="Export armatures in REST mode instead of POSE mode",
@@ -346,11 +576,34 @@ class OSGGUI(bpy.types.Operator, ExportHelper):
 
         self.EXPORTANIM = self.config.export_anim
         self.APPLYMODIFIERS = self.config.apply_modifiers
+        self.SPLIT_GEOMETRIES = self.config.split_large_geometries
+        self.CHUNK_MESHES = self.config.chunk_large_meshes
+        self.CHUNK_TRIANGLES = self.config.chunk_triangle_count
+        self.SPATIAL_HIERARCHY = self.config.spatial_hierarchy
+        self.SPATIAL_LEAF_SIZE = self.config.spatial_leaf_size
+        self.STATIC_BATCHING = self.config.static_batching
+        self.BATCH_VERTEX_BUDGET = self.config.batch_vertex_budget
+        self.OPTIMIZE_SCENE_GRAPH = self.config.optimize_scene_graph
+        self.FLATTEN_TRANSFORMS = self.config.flatten_static_transforms
+        self.SHARE_COLLECTIONS = self.config.share_collection_instances
+        self.SHARE_INSTANCES = self.config.share_object_instances
+        self.CACHE_DIR = self.config.conversion_cache_dir
+        self.CACHE_SIZE = self.config.conversion_cache_size
+        self.LIVE_EXPORT = self.config.live_export
         self.LOG = self.config.log
         self.BAKE_ALL = self.config.bake_animations
         self.USE_QUATERNIONS = self.config.use_quaternions
         self.BAKE_CONSTRAINTS = self.config.bake_constraints
         self.BAKE_FRAME_STEP = self.config.bake_frame_step
+        self.BAKE_TO_CHANNELS = self.config.bake_to_channels
+        self.SELECTIVE_BAKING = self.config.selective_baking
+        self.EULER_TO_QUATERNION = self.config.convert_euler_rotations
+        self.PRUNE_CHANNELS = self.config.prune_constant_channels
+        self.PRUNE_STACKED = self.config.prune_stacked_transforms
+        self.REDUCE_KEYFRAMES = self.config.reduce_keyframes
+        self.POSITION_TOLERANCE = self.config.keyframe_position_tolerance
+        self.SCALE_TOLERANCE = self.config.keyframe_scale_tolerance
+        self.ROTATION_TOLERANCE = self.config.keyframe_rotation_tolerance
         self.ARMATURE_REST = self.config.arm_rest
         self.ARMATURE_DEFORM_ONLY = self.config.arm_deform_only
         self.OSGCONV_TO_IVE = self.config.osgconv_to_ive
@@ -389,11 +642,34 @@ class OSGGUI(bpy.types.Operator, ExportHelper):
         self.config.anim_fps = self.ANIMFPS
         self.config.export_anim = self.EXPORTANIM
         self.config.apply_modifiers = self.APPLYMODIFIERS
+        self.config.split_large_geometries = self.SPLIT_GEOMETRIES
+        self.config.chunk_large_meshes = self.CHUNK_MESHES
+        self.config.chunk_triangle_count = self.CHUNK_TRIANGLES
+        self.config.spatial_hierarchy = self.SPATIAL_HIERARCHY
+        self.config.spatial_leaf_size = self.SPATIAL_LEAF_SIZE
+        self.config.static_batching = self.STATIC_BATCHING
+        self.config.batch_vertex_budget = self.BATCH_VERTEX_BUDGET
+        self.config.optimize_scene_graph = self.OPTIMIZE_SCENE_GRAPH
+        self.config.flatten_static_transforms = self.FLATTEN_TRANSFORMS
+        self.config.share_collection_instances = self.SHARE_COLLECTIONS
+        self.config.share_object_instances = self.SHARE_INSTANCES
+        self.config.conversion_cache_dir = self.CACHE_DIR
+        self.config.conversion_cache_size = self.CACHE_SIZE
+        self.config.live_export = self.LIVE_EXPORT
         self.config.log = self.LOG
         self.config.bake_animations = self.BAKE_ALL
         self.config.use_quaternions = self.USE_QUATERNIONS
         self.config.bake_constraints = self.BAKE_CONSTRAINTS
         self.config.bake_frame_step = self.BAKE_FRAME_STEP
+        self.config.bake_to_channels = self.BAKE_TO_CHANNELS
+        self.config.selective_baking = self.SELECTIVE_BAKING
+        self.config.convert_euler_rotations = self.EULER_TO_QUATERNION
+        self.config.prune_constant_channels = self.PRUNE_CHANNELS
+        self.config.prune_stacked_transforms = self.PRUNE_STACKED
+        self.config.reduce_keyframes = self.REDUCE_KEYFRAMES
+        self.config.keyframe_position_tolerance = self.POSITION_TOLERANCE
+        self.config.keyframe_scale_tolerance = self.SCALE_TOLERANCE
+        self.config.keyframe_rotation_tolerance = self.ROTATION_TOLERANCE
         self.config.arm_rest = self.ARMATURE_REST
         self.config.arm_deform_only = self.ARMATURE_DEFORM_ONLY
         self.config.osgconv_to_ive = self.OSGCONV_TO_IVE
@@ -415,7 +691,12 @@ class OSGGUI(bpy.types.Operator, ExportHelper):
         except Exception:
             pass
 
-        if self.config.export_all_scenes:
+        # exporting again without live export stops watching the scene
+        osgwatch.stopLiveExport()
+        if self.config.live_export:
+            self.config.scene = context.scene
+            osgwatch.startLiveExport(self.config)
+        elif self.config.export_all_scenes:
             for scene in bpy.data.scenes:
                 self.config.scene = scene
                 print(self.filepath + "_" + scene.name)
@@ -464,6 +745,9 @@ class OSGT_PT_export_include(bpy.types.Panel):
         #col = layout.column(align = False)
         #col.prop(operator, 'AUTHOR')
 
+        col = layout.column(align = True)
+        col.prop(operator, 'LIVE_EXPORT')
+
 
 class OSGT_PT_export_transform(bpy.types.Panel):
     bl_space_type = 'FILE_BROWSER'
@@ -515,6 +799,19 @@ class OSGT_PT_export_geometry(bpy.types.Panel):
         
         col = layout.column(align = True)
         col.prop(operator, 'APPLYMODIFIERS')
+        col.prop(operator, 'SPLIT_GEOMETRIES')
+        col.prop(operator, 'CHUNK_MESHES')
+        col.prop(operator, 'CHUNK_TRIANGLES')
+        col.prop(operator, 'SPATIAL_HIERARCHY')
+        col.prop(operator, 'SPATIAL_LEAF_SIZE')
+        col.prop(operator, 'STATIC_BATCHING')
+        col.prop(operator, 'BATCH_VERTEX_BUDGET')
+        col.prop(operator, 'OPTIMIZE_SCENE_GRAPH')
+        col.prop(operator, 'FLATTEN_TRANSFORMS')
+        col.prop(operator, 'SHARE_COLLECTIONS')
+        col.prop(operator, 'SHARE_INSTANCES')
+        col.prop(operator, 'CACHE_DIR')
+        col.prop(operator, 'CACHE_SIZE')
 
 
 class OSGT_PT_export_armature(bpy.types.Panel):
@@ -577,7 +874,16 @@ class OSGT_PT_export_animation(bpy.types.Panel):
         col.prop(operator, 'BAKE_FRAME_STEP', text="Sampling Rate")
         col.prop(operator, 'BAKE_ALL')
         col.prop(operator, 'BAKE_CONSTRAINTS')
+        col.prop(operator, 'BAKE_TO_CHANNELS')
+        col.prop(operator, 'SELECTIVE_BAKING')
         col.prop(operator, 'USE_QUATERNIONS')
+        col.prop(operator, 'EULER_TO_QUATERNION')
+        col.prop(operator, 'PRUNE_CHANNELS')
+        col.prop(operator, 'PRUNE_STACKED')
+        col.prop(operator, 'REDUCE_KEYFRAMES')
+        col.prop(operator, 'POSITION_TOLERANCE')
+        col.prop(operator, 'SCALE_TOLERANCE')
+        col.prop(operator, 'ROTATION_TOLERANCE')
         col.prop(operator, 'EXPORT_TEXTKEYS')
 
 
@@ -687,7 +993,9 @@ def register():
 
 def unregister():
     from bpy.utils import unregister_class
-    
+
+    # the live export handlers would keep running against the unloaded module
+    osgwatch.stopLiveExport()
     for c in classes:
         bpy.utils.unregister_class(c)
         
@@ -0,0 +1,303 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import math
+import mathutils
+from collections import OrderedDict
+from . import osglog
+from .osgobject import *
+from .osgoptimize import isIdentity
+
+Log = osglog.log
+
+
+# INTERPOLATION
+# -------------
+def lerp(a, b, t):
+    return [x + (y - x) * t for (x, y) in zip(a, b)]
+
+
+def slerp(a, b, t):
+    ''' Spherical interpolation of quaternions, as done by QuatSphericalLinearChannel '''
+    dot = sum(x * y for (x, y) in zip(a, b))
+    if dot < 0.0:
+        b = [-y for y in b]
+        dot = -dot
+    if dot > 0.9995:
+        q = lerp(a, b, t)
+        norm = math.sqrt(sum(x * x for x in q))
+        return [x / norm for x in q]
+    theta = math.acos(dot)
+    sin_theta = math.sin(theta)
+    wa = math.sin((1.0 - t) * theta) / sin_theta
+    wb = math.sin(t * theta) / sin_theta
+    return [wa * x + wb * y for (x, y) in zip(a, b)]
+
+
+def vectorError(a, b):
+    return max(abs(x - y) for (x, y) in zip(a, b))
+
+
+def quaternionError(a, b):
+    ''' Angle in radians between two rotations '''
+    dot = abs(sum(x * y for (x, y) in zip(a, b)))
+    norm = math.sqrt(sum(x * x for x in a) * sum(y * y for y in b))
+    if norm == 0.0:
+        return 0.0
+    return 2.0 * math.acos(min(1.0, dot / norm))
+
+
+# KEYFRAME REDUCTION
+# ------------------
+def reduceKeys(keys, tolerance, interpolate=lerp, error=vectorError):
+    '''
+    Keep the keys ([time, values...]) that interpolating their kept neighbours
+    cannot reproduce within tolerance, the first and last keys are always kept
+    '''
+    if len(keys) < 3:
+        return keys
+    keep = [False] * len(keys)
+    keep[0] = keep[-1] = True
+    segments = [(0, len(keys) - 1)]
+    while segments:
+        first, last = segments.pop()
+        start, end = keys[first], keys[last]
+        duration = end[0] - start[0]
+        worst = None
+        worst_error = tolerance
+        for i in range(first + 1, last):
+            t = (keys[i][0] - start[0]) / duration if duration > 0.0 else 0.0
+            e = error(interpolate(start[1:], end[1:], t), keys[i][1:])
+            if e > worst_error:
+                worst = i
+                worst_error = e
+        if worst is not None:
+            keep[worst] = True
+            segments.append((first, worst))
+            segments.append((worst, last))
+    return [key for (key, kept) in zip(keys, keep) if kept]
+
+
+def removeFlatKeys(keys, epsilon=0.0001):
+    ''' Remove the keys equal to both their neighbours, like osgbake.cleanAction does on fcurves '''
+    if len(keys) < 3:
+        return keys
+    result = [keys[0]]
+    for i in range(1, len(keys) - 1):
+        previous = result[-1][1:]
+        value = keys[i][1:]
+        following = keys[i + 1][1:]
+        if sum(abs(a - b) for (a, b) in zip(value, previous)) + \
+           sum(abs(a - b) for (a, b) in zip(value, following)) >= epsilon:
+            result.append(keys[i])
+    result.append(keys[-1])
+    return result
+
+
+def getChannelTolerance(channel, position_tolerance, scale_tolerance, rotation_tolerance):
+    ''' Returns (tolerance, interpolate, error) for a channel, rotation_tolerance is in degrees '''
+    if channel.name == "quaternion":
+        return (math.radians(rotation_tolerance), slerp, quaternionError)
+    if channel.name == "translate":
+        return (position_tolerance, lerp, vectorError)
+    if channel.name.startswith("euler") or channel.name == "axis_angle":
+        return (math.radians(rotation_tolerance), lerp, vectorError)
+    # scales and morph weights
+    return (scale_tolerance, lerp, vectorError)
+
+
+def reduceChannels(channels, position_tolerance, scale_tolerance, rotation_tolerance):
+    ''' Remove the keys of the channels that linear interpolation reproduces '''
+    before = 0
+    after = 0
+    for channel in channels:
+        tolerance, interpolate, error = getChannelTolerance(channel,
+                                                            position_tolerance,
+                                                            scale_tolerance,
+                                                            rotation_tolerance)
+        before += len(channel.keys)
+        channel.keys = reduceKeys(channel.keys, tolerance, interpolate, error)
+        after += len(channel.keys)
+    Log("keyframe reduction kept {} of {} keys".format(after, before))
+
+
+def reduceAnimations(animations, position_tolerance, scale_tolerance, rotation_tolerance):
+    ''' Remove the keys of the animation channels that linear interpolation reproduces '''
+    reduceChannels([channel for animation in animations for channel in animation.channels],
+                   position_tolerance, scale_tolerance, rotation_tolerance)
+
+
+# CONSTANT CHANNELS
+# -----------------
+def collectUpdateTransforms(node, callbacks, visited=None):
+    ''' Map the names of the UpdateMatrixTransform and UpdateBone callbacks of a graph to them '''
+    if visited is None:
+        visited = set()
+    if id(node) in visited:
+        return callbacks
+    visited.add(id(node))
+    for callback in getattr(node, "update_callbacks", []):
+        while callback is not None:
+            if isinstance(callback, UpdateMatrixTransform):
+                callbacks.setdefault(callback.name, []).append(callback)
+            callback = getattr(callback, "nested_callback", None)
+    for child in getattr(node, "children", []):
+        collectUpdateTransforms(child, callbacks, visited)
+    return callbacks
+
+
+def findStackedElements(callbacks, name):
+    return [element for callback in callbacks for element in callback.stacked_transforms if element.name == name]
+
+
+def getElementValue(element):
+    ''' Value of a stacked element in the layout of the channel animating it '''
+    if isinstance(element, StackedTranslateElement):
+        return list(element.translate)
+    if isinstance(element, StackedScaleElement):
+        return list(element.scale)
+    if isinstance(element, StackedQuaternionElement):
+        q = element.quaternion
+        return [q.x, q.y, q.z, q.w]
+    if isinstance(element, StackedRotateAxisElement):
+        if element.name == "axis_angle":
+            return list(element.axis) + [element.angle]
+        return [element.angle]
+    return None
+
+
+def setElementValue(element, value):
+    if isinstance(element, StackedTranslateElement):
+        element.translate = Vector(value)
+    elif isinstance(element, StackedScaleElement):
+        element.scale = Vector(value)
+    elif isinstance(element, StackedQuaternionElement):
+        element.quaternion = mathutils.Quaternion((value[3], value[0], value[1], value[2]))
+    elif element.name == "axis_angle":
+        element.axis = Vector(value[0:3])
+        element.angle = value[3]
+    else:
+        element.angle = value[0]
+
+
+def getConstantValue(channel, tolerance, error):
+    ''' Returns the value of a channel holding the same value on every key, None otherwise '''
+    if not channel.keys:
+        return None
+    value = channel.keys[0][1:]
+    for key in channel.keys[1:]:
+        if error(value, key[1:]) > tolerance:
+            return None
+    return value
+
+
+def pruneConstantChannels(root, animations, position_tolerance, scale_tolerance, rotation_tolerance):
+    '''
+    Remove the channels holding a constant value on the stacked element they target.
+    The value is folded into the element default, which is only done when every
+    animation holds the same constant so that none of them depends on the old default
+    '''
+    callbacks = collectUpdateTransforms(root, {})
+    groups = OrderedDict()
+    for animation in animations:
+        for channel in animation.channels:
+            groups.setdefault((channel.target, channel.name), []).append((animation, channel))
+
+    removed = 0
+    for ((target, name), channels) in groups.items():
+        elements = findStackedElements(callbacks.get(target, []), name)
+        if not elements:
+            # morph weights and channels without a stacked element
+            continue
+        tolerance, interpolate, error = getChannelTolerance(channels[0][1],
+                                                            position_tolerance,
+                                                            scale_tolerance,
+                                                            rotation_tolerance)
+        values = [getConstantValue(channel, tolerance, error) for (animation, channel) in channels]
+        if any(value is None for value in values) or \
+           any(error(values[0], value) > tolerance for value in values[1:]):
+            continue
+        at_default = all(error(getElementValue(element), values[0]) <= tolerance for element in elements)
+        if not at_default:
+            if len(channels) < len(animations):
+                # an animation without this channel uses the current default
+                continue
+            for element in elements:
+                setElementValue(element, values[0])
+        for (animation, channel) in channels:
+            animation.channels.remove(channel)
+            removed += 1
+    Log("removed {} constant channels".format(removed))
+
+
+# STACKED TRANSFORMS
+# ------------------
+def getElementMatrix(element):
+    ''' Matrix of a stacked element, None for elements that can not be folded '''
+    if isinstance(element, StackedMatrixElement):
+        return element.matrix.copy()
+    if isinstance(element, StackedTranslateElement):
+        return Matrix.Translation(element.translate)
+    if isinstance(element, StackedQuaternionElement):
+        return element.quaternion.to_matrix().to_4x4()
+    if isinstance(element, StackedScaleElement):
+        return Matrix.Diagonal(list(element.scale) + [1.0])
+    if isinstance(element, StackedRotateAxisElement):
+        return Matrix.Rotation(element.angle, 4, Vector(element.axis))
+    return None
+
+
+def foldStackedTransforms(callback, targeted):
+    '''
+    Replace each run of stacked elements no channel targets with a single matrix element,
+    the run holding the bind matrix keeps its name
+    '''
+    elements = []
+    run_matrix = None
+    run_name = "matrix"
+    for element in callback.stacked_transforms:
+        matrix = None if element.name in targeted else getElementMatrix(element)
+        if matrix is not None:
+            run_matrix = matrix if run_matrix is None else run_matrix @ matrix
+            if element.name == "bindmatrix":
+                run_name = "bindmatrix"
+            continue
+        if run_matrix is not None and (run_name == "bindmatrix" or not isIdentity(run_matrix)):
+            elements.append(StackedMatrixElement(name=run_name, matrix=run_matrix))
+        run_matrix = None
+        run_name = "matrix"
+        elements.append(element)
+    if run_matrix is not None and (run_name == "bindmatrix" or not isIdentity(run_matrix)):
+        elements.append(StackedMatrixElement(name=run_name, matrix=run_matrix))
+    removed = len(callback.stacked_transforms) - len(elements)
+    callback.stacked_transforms = elements
+    return removed
+
+
+def pruneStackedTransforms(root, animations):
+    ''' Fold the stacked elements of the update callbacks that no animation channel targets '''
+    targeted = {}
+    for animation in animations:
+        for channel in animation.channels:
+            targeted.setdefault(channel.target, set()).add(channel.name)
+
+    removed = 0
+    for (name, callbacks) in collectUpdateTransforms(root, {}).items():
+        for callback in callbacks:
+            removed += foldStackedTransforms(callback, targeted.get(name, set()))
+    Log("removed {} stacked transform elements".format(removed))
@@ -17,11 +17,16 @@
 # ##### END GPL LICENSE BLOCK #####
 
 # <pep8-80 compliant>
+import array
 import bpy
 import bisect
+import re
 from mathutils import Vector, Matrix
+from . import osglog
 from .osgutils import *
 
+Log = osglog.log
+
 
 def cleanAction(action):
     for fcu in action.fcurves:
@@ -41,10 +46,15 @@ def cleanAction(action):
 def bakeMorphTargets(frame_start,
                      frame_end,
                      blender_object,
-                     frame_step=1):
+                     frame_step=1,
+                     samples=None):
 
     def collectValues(morph_info, frame_range):
         'Collect shape keys factors for each frame in frame range'
+        if samples is not None:
+            for block in morph_info:
+                morph_info[block] = samples.select(samples.blocks[block], frame_range, morph=True)
+            return
         for f in frame_range:
             scene.frame_set(f)
             bpy.context.view_layer.update()
@@ -78,10 +88,16 @@ def bakeMorphTargets(frame_start,
         'Convert absolute shape keys to relative'
         # Absolute keyframe are always ordered through time
         keyFrames = [block.frame for block in shape.key_blocks]
-        for f in frame_range:
-            scene.frame_set(f)
-            bpy.context.view_layer.update()
-            values = evaluateActiveShapeKeys(shape.eval_time, keyFrames)
+        if samples is not None:
+            eval_times = samples.select(samples.eval_times[shape], frame_range, morph=True)
+        else:
+            eval_times = []
+            for f in frame_range:
+                scene.frame_set(f)
+                bpy.context.view_layer.update()
+                eval_times.append(shape.eval_time)
+        for eval_time in eval_times:
+            values = evaluateActiveShapeKeys(eval_time, keyFrames)
             for block in morph_info:
                 if block == values['previous']:
                     morph_info[block].append(1 - values['factor'])
@@ -121,12 +137,246 @@ def bakeMorphTargets(frame_start,
     setKeyframes(shape, frame_range)
     cleanAction(new_action)
     shape.animation_data.action = original_action
-    scene.frame_set(frame_back)
-    bpy.context.view_layer.update()
+    if samples is None:
+        scene.frame_set(frame_back)
+        bpy.context.view_layer.update()
 
     return new_action
 
 
+def getPoseBoneLocalMatrix(blender_object, pbone):
+    # As there is no similar "use_inherit_rotation" property in osg, we have to temporarily enable
+    # it here to get the good baking results and the good bone transforms
+    backup_rotation_inheritance = pbone.bone.use_inherit_rotation
+    if not backup_rotation_inheritance:
+        pbone.bone.use_inherit_rotation = True
+    # Get the final transform of the bone in its own local space...
+    matrix = blender_object.convert_space(pose_bone=pbone, matrix=pbone.matrix, from_space='POSE', to_space='LOCAL')
+    if not backup_rotation_inheritance:
+        pbone.bone.use_inherit_rotation = backup_rotation_inheritance
+    return matrix
+
+
+class PoseSampler(object):
+    '''
+    Local matrices of all the bones of an armature, computed from a single bulk read of their
+    pose space matrices and the rest hierarchy without changing any bone flag. osg bones always
+    fully inherit from their parent, so the local matrix is the one giving back the pose matrix
+    through the parent pose and the rest offset. For bones inheriting scale and using local
+    location it is the one of convert_space to the LOCAL space with rotation inheritance forced
+    '''
+    def __init__(self, blender_object):
+        self.object = blender_object
+        bones = blender_object.data.bones
+        self.names = [pbone.name for pbone in blender_object.pose.bones]
+        index = dict((name, i) for (i, name) in enumerate(self.names))
+        self.parents = []
+        self.inverse_offsets = []
+        for name in self.names:
+            bone = bones[name]
+            if bone.parent:
+                offset = bone.parent.matrix_local.inverted_safe() @ bone.matrix_local
+                self.parents.append(index[bone.parent.name])
+            else:
+                offset = bone.matrix_local
+                self.parents.append(None)
+            self.inverse_offsets.append(offset.inverted_safe())
+        self.buffer = array.array('f', [0]) * (16 * len(self.names))
+
+    def sample(self):
+        self.object.pose.bones.foreach_get('matrix', self.buffer)
+        b = self.buffer
+        # matrices are stored column by column
+        poses = [Matrix((b[i:i + 4], b[i + 4:i + 8], b[i + 8:i + 12], b[i + 12:i + 16])).transposed()
+                 for i in range(0, len(b), 16)]
+        inverse_poses = {}
+        matrix = {}
+        for (i, name) in enumerate(self.names):
+            parent = self.parents[i]
+            if parent is None:
+                matrix[name] = self.inverse_offsets[i] @ poses[i]
+            else:
+                if parent not in inverse_poses:
+                    inverse_poses[parent] = poses[parent].inverted_safe()
+                matrix[name] = self.inverse_offsets[i] @ inverse_poses[parent] @ poses[i]
+        return matrix
+
+    def getFrameInfo(self, blender_object, do_visual_keying):
+        return self.sample()
+
+
+def getPoseFrameInfo(blender_object, do_visual_keying):
+    matrix = {}
+    for name, pbone in blender_object.pose.bones.items():
+        if do_visual_keying:
+            matrix[name] = getPoseBoneLocalMatrix(blender_object, pbone)
+        else:
+            matrix[name] = pbone.matrix_basis.copy()
+    return matrix
+
+
+def getBoneCorrection(blender_object):
+    ''' Blender parents objects to the tail of a bone, osg to its head '''
+    if blender_object.parent_bone and blender_object.parent:
+        bone = blender_object.parent.data.bones[blender_object.parent_bone]
+        return Vector((0, bone.tail_local.z - bone.head_local.z, 0))
+    return Vector((0, 0, 0))
+
+
+# fcurve data paths of the transforms of an object or of one of its pose bones
+TRANSFORM_PATH = re.compile(r'^(?:pose\.bones\["(.+)"\]\.)?'
+                            r'(location|rotation_quaternion|rotation_euler|rotation_axis_angle|scale)$')
+
+
+def getBakeSelection(blender_object, action=None):
+    '''
+    Returns (names of the bones, bake object) whose evaluated transforms differ from their fcurves:
+    constrained bones and the chains their IK constraints move, driven transforms, transforms
+    with non linear keys and bones not fully inheriting from a moving parent, since the baked
+    local matrices always inherit. Other bones can keep the keys of their action
+    '''
+    bones = set()
+    animated = set()
+    bake_object = any(not constraint.mute for constraint in blender_object.constraints)
+
+    fcurves = []
+    if action:
+        for fcurve in action.fcurves:
+            match = TRANSFORM_PATH.match(fcurve.data_path)
+            if match and match.group(1) is not None:
+                animated.add(match.group(1))
+            if any(key.interpolation != 'LINEAR' for key in fcurve.keyframe_points):
+                fcurves.append(fcurve)
+    if blender_object.animation_data:
+        fcurves.extend(blender_object.animation_data.drivers)
+    for fcurve in fcurves:
+        match = TRANSFORM_PATH.match(fcurve.data_path)
+        if not match:
+            continue
+        if match.group(1) is None:
+            bake_object = True
+        else:
+            bones.add(match.group(1))
+
+    if blender_object.pose is not None:
+        for pbone in blender_object.pose.bones:
+            for constraint in pbone.constraints:
+                if constraint.mute:
+                    continue
+                bones.add(pbone.name)
+                if constraint.type in ('IK', 'SPLINE_IK'):
+                    # a chain count of 0 moves every parent up to the root
+                    chain = pbone.parent_recursive
+                    if constraint.chain_count > 0:
+                        chain = chain[:constraint.chain_count - 1]
+                    bones.update(parent.name for parent in chain)
+
+        partial = [pbone for pbone in blender_object.pose.bones
+                   if not pbone.bone.use_inherit_rotation or pbone.bone.inherit_scale != 'FULL' or
+                   not pbone.bone.use_local_location]
+        # a baked bone can move the parents of other partially inheriting bones
+        selected = True
+        while selected:
+            selected = False
+            for pbone in partial:
+                if pbone.name not in bones and \
+                   any(parent.name in bones or parent.name in animated for parent in pbone.parent_recursive):
+                    bones.add(pbone.name)
+                    selected = True
+
+    return bones, bake_object
+
+
+def getObjectFrameInfo(blender_object, do_visual_keying):
+    return blender_object.matrix_local.copy() if do_visual_keying else blender_object.matrix_basis.copy()
+
+
+class BakeSamples(object):
+    ''' Transforms and shape keys of several objects sampled in a single sweep of the timeline '''
+    def __init__(self, frames, morph_frames):
+        # transforms and shape keys are sampled on their own frames
+        self.frames = frames
+        self.frame_index = dict((f, i) for (i, f) in enumerate(frames))
+        self.morph_frames = morph_frames
+        self.morph_frame_index = dict((f, i) for (i, f) in enumerate(morph_frames))
+        self.pose = {}  # object -> [{bone name: local matrix}]
+        self.object = {}  # object -> [local matrix]
+        self.blocks = {}  # shape key block -> [value] for relative shape keys
+        self.eval_times = {}  # shape keys -> [eval_time] for absolute shape keys
+
+    def covers(self, frame_range, morph=False):
+        frame_index = self.morph_frame_index if morph else self.frame_index
+        return all(f in frame_index for f in frame_range)
+
+    def select(self, values, frame_range, morph=False):
+        frame_index = self.morph_frame_index if morph else self.frame_index
+        return [values[frame_index[f]] for f in frame_range]
+
+
+class BakeScheduler(object):
+    '''
+    Samples every object that may need baking the first time a bake is requested,
+    so the scene is evaluated once per frame instead of once per frame and object.
+    Objects are candidates as soon as they are animated, sampling one that is not
+    baked afterwards only costs reading its transforms
+    '''
+    def __init__(self, scene, objects, frame_step=1):
+        self.scene = scene
+        self.frame_step = frame_step
+        self.objects = [obj for obj in objects
+                        if hasAction(obj) or hasNLATracks(obj) or hasSolidConstraints(obj) or
+                        hasExternalBoneConstraints(obj)]
+        self.morph_objects = [obj for obj in objects if obj.type == 'MESH' and hasShapeKeysAnimation(obj)]
+        self.samples = {}
+
+    def getSamples(self, blender_object, frame_start, frame_end, frame_step=1, morph=False):
+        ''' Returns the samples covering the frames, None when the object is not sampled '''
+        if blender_object not in (self.morph_objects if morph else self.objects):
+            return None
+        frame_range = range(frame_start, frame_end + 1, frame_step)
+        for samples in self.samples.values():
+            if samples.covers(frame_range, morph):
+                return samples
+        # shape keys are always baked on every frame, transforms on every frame_step
+        frames = set(range(frame_start, frame_end + 1, self.frame_step)) if self.objects else set()
+        morph_frames = set(range(frame_start, frame_end + 1)) if self.morph_objects else set()
+        (morph_frames if morph else frames).update(frame_range)
+        samples = self.sweep(sorted(frames), sorted(morph_frames))
+        self.samples[(frame_start, frame_end)] = samples
+        return samples
+
+    def sweep(self, frames, morph_frames):
+        samples = BakeSamples(frames, morph_frames)
+        frame_back = self.scene.frame_current
+        # Set armatures to POSE mode before baking to bake the good transforms
+        rest_armatures = setArmaturesPosePosition(self.scene, 'POSE')
+        pose_samplers = dict((obj, PoseSampler(obj)) for obj in self.objects if obj.pose is not None)
+        for f in sorted(samples.frame_index.keys() | samples.morph_frame_index.keys()):
+            self.scene.frame_set(f)
+            bpy.context.view_layer.update()
+            if f in samples.frame_index:
+                for obj in self.objects:
+                    if obj.pose is not None:
+                        samples.pose.setdefault(obj, []).append(pose_samplers[obj].sample())
+                    samples.object.setdefault(obj, []).append(getObjectFrameInfo(obj, True))
+            if f not in samples.morph_frame_index:
+                continue
+            for obj in self.morph_objects:
+                shape = obj.data.shape_keys
+                if shape.use_relative:
+                    for block in shape.key_blocks:
+                        samples.blocks.setdefault(block, []).append(block.value)
+                else:
+                    samples.eval_times.setdefault(shape, []).append(shape.eval_time)
+        self.scene.frame_set(frame_back)
+        bpy.context.view_layer.update()
+        if rest_armatures:
+            setArmaturesPosePosition(self.scene, 'REST', rest_armatures)
+        Log("sampled {} objects on {} frames and {} shape keys on {} frames"
+            .format(len(self.objects), len(frames), len(self.morph_objects), len(morph_frames)))
+        return samples
+
+
 # This function comes from bpy_extras.anim_utils and has been
 # added here to allow more control on baking process
 def bakeAction(blender_object,
@@ -143,6 +393,8 @@ def bakeAction(blender_object,
                do_clean=False,
                action=None,
                bake_deform_only=False,
+               samples=None,
+               bones=None,
                ):
 
     """
@@ -172,6 +424,11 @@ def bakeAction(blender_object,
     :arg action: An action to bake the data into, or None for a new action
        to be created.
     :type action: :class:`bpy.types.Action` or None
+    :arg samples: Transforms already sampled for this object, or None to
+       step the timeline.
+    :type samples: :class:`BakeSamples` or None
+    :arg bones: Names of the pose bones to bake, or None for all of them.
+    :type bones: set or None
 
     :return: an action or None
     :rtype: :class:`bpy.types.Action`
@@ -179,21 +436,10 @@ def bakeAction(blender_object,
 
     # -------------------------------------------------------------------------
     # Helper Functions and vars
-    def poseFrameInfo(blender_object, do_visual_keying):
-        matrix = {}
-        for name, pbone in blender_object.pose.bones.items():
-            # As there is no similar "use_inherit_rotation" property in osg, we have to temporarily enable
-            # it here to get the good baking results and the good bone transforms
-            backup_rotation_inheritance = pbone.bone.use_inherit_rotation
-            pbone.bone.use_inherit_rotation = True
-            if do_visual_keying:
-                # Get the final transform of the bone in its own local space...
-                matrix[name] = blender_object.convert_space(pose_bone=pbone, matrix=pbone.matrix, from_space='POSE', to_space='LOCAL')
-            else:
-                matrix[name] = pbone.matrix_basis.copy()
-
-            pbone.bone.use_inherit_rotation = backup_rotation_inheritance
-        return matrix
+    if do_pose and blender_object.pose is not None and do_visual_keying:
+        poseFrameInfo = PoseSampler(blender_object).getFrameInfo
+    else:
+        poseFrameInfo = getPoseFrameInfo
 
     if do_parents_clear:
         def objFrameInfo(blender_object, do_visual_keying):
@@ -204,8 +450,7 @@ def bakeAction(blender_object,
             else:
                 return matrix.copy()
     else:
-        def objFrameInfo(blender_object, do_visual_keying):
-            return blender_object.matrix_local.copy() if do_visual_keying else blender_object.matrix_basis.copy()
+        objFrameInfo = getObjectFrameInfo
 
     # -------------------------------------------------------------------------
     # Setup the Context
@@ -213,11 +458,7 @@ def bakeAction(blender_object,
     # TODO, pass data rather then grabbing from the context!
     scene = bpy.context.scene
     frame_back = scene.frame_current
-    bone_correction = Vector((0, 0, 0))
-    if blender_object.parent_bone and blender_object.parent:
-        bone_height = blender_object.parent.data.bones[blender_object.parent_bone].tail_local.z \
-            - blender_object.parent.data.bones[blender_object.parent_bone].head_local.z
-        bone_correction = Vector((0, bone_height, 0))
+    bone_correction = getBoneCorrection(blender_object)
 
     if blender_object.pose is None:
         do_pose = False
@@ -234,13 +475,19 @@ def bakeAction(blender_object,
 
     # -------------------------------------------------------------------------
     # Collect transformations
-    for f in frame_range:
-        scene.frame_set(f)
-        bpy.context.view_layer.update()
+    if samples is not None:
         if do_pose:
-            pose_info.append(poseFrameInfo(blender_object, do_visual_keying))
+            pose_info = samples.select(samples.pose[blender_object], frame_range)
         if do_object:
-            obj_info.append(objFrameInfo(blender_object, do_visual_keying))
+            obj_info = samples.select(samples.object[blender_object], frame_range)
+    else:
+        for f in frame_range:
+            scene.frame_set(f)
+            bpy.context.view_layer.update()
+            if do_pose:
+                pose_info.append(poseFrameInfo(blender_object, do_visual_keying))
+            if do_object:
+                obj_info.append(objFrameInfo(blender_object, do_visual_keying))
 
     # -------------------------------------------------------------------------
     # Create action
@@ -259,6 +506,8 @@ def bakeAction(blender_object,
         for name, pbone in blender_object.pose.bones.items():
             if only_selected and not pbone.bone.select:
                 continue
+            if bones is not None and name not in bones:
+                continue
             if bake_deform_only and not isDeform(blender_object.data.bones[pbone.name]):
                 continue
             # Quaternions are forced for bones
@@ -381,12 +630,14 @@ def bakeAction(blender_object,
 
 
 # take care of restoring selection after
-def bakeAnimation(scene, start, end, frame_step, blender_object, has_action=False, use_quaternions=False, deform_only=False):
+def bakeAnimation(scene, start, end, frame_step, blender_object, has_action=False, use_quaternions=False, deform_only=False,
+                  samples=None, bones=None, do_object=True):
     # baking will replace the current action but we want to keep scene unchanged
     original_action = blender_object.animation_data.action if has_action else None
 
-    # Set armatures to POSE mode before baking to bake the good transforms
-    rest_armatures = setArmaturesPosePosition(scene, 'POSE')
+    # Set armatures to POSE mode before baking to bake the good transforms,
+    # samples were already taken in POSE mode
+    rest_armatures = setArmaturesPosePosition(scene, 'POSE') if samples is None else []
 
     do_visual_keying = True  # Always, need to take bone constraints  into account
 
@@ -398,16 +649,19 @@ def bakeAnimation(scene, start, end, frame_step, blender_object, has_action=Fals
                               do_clean=True,  # clean keyframes
                               do_constraint_clear=False,
                               do_parents_clear=False,
-                              do_object=True,  # bake solid animation
-                              do_pose=True,  # bake skeletal animation
+                              do_object=do_object,  # bake solid animation
+                              do_pose=bones is None or len(bones) > 0,  # bake skeletal animation
                               use_quaternions=use_quaternions,  # use_quaternions,
                               # visual keying bakes in worldspace, but here we want it local since we keep parenting
                               do_visual_keying=do_visual_keying,
                               bake_deform_only=deform_only,
+                              samples=samples,
+                              bones=bones,
                               )
 
     # restore original action and armatures' pose position
     blender_object.animation_data.action = original_action
-    setArmaturesPosePosition(scene, 'REST', rest_armatures)
+    if rest_armatures:
+        setArmaturesPosePosition(scene, 'REST', rest_armatures)
 
     return baked_action
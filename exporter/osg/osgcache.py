@@ -0,0 +1,185 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import array
+import hashlib
+import os
+import pickle
+import zlib
+from collections import OrderedDict
+from . import osglog
+from .osgobject import *
+
+Log = osglog.log
+
+# Bump it when the converted geometry layout changes
+CACHE_VERSION = 1
+CACHE_EXTENSION = ".osgcache"
+
+
+# PAYLOADS
+# --------
+def geometryToPayload(material_index, geometry):
+    ''' Plain python description of a converted geometry, its stateset is rebuilt on load '''
+    groups = getattr(geometry, "groups", {})
+    return {"material_index": material_index,
+            "name": geometry.name,
+            "vertexes": geometry.vertexes.getArray(),
+            "normals": geometry.normals.getArray() if geometry.normals is not None else None,
+            "colors": geometry.colors.getArray() if geometry.colors is not None else None,
+            "uvs": [(key, uv.index, uv.getArray()) for key, uv in geometry.uvs.items()],
+            "primitives": [(primitive.type, primitive.indexes) for primitive in geometry.primitives],
+            "groups": [(key, group.targetGroupName, group.vertexes) for key, group in groups.items()]}
+
+
+def payloadToGeometry(payload):
+    ''' Returns (material_index, geometry) from a cached payload '''
+    geometry = Geometry()
+    geometry.setName(payload["name"])
+    geometry.vertexes = VertexArray(array=payload["vertexes"])
+    if payload["normals"] is not None:
+        geometry.normals = NormalArray(array=payload["normals"])
+    if payload["colors"] is not None:
+        geometry.colors = ColorArray(array=payload["colors"])
+    for (key, index, uvs) in payload["uvs"]:
+        geometry.uvs[key] = TexCoordArray(array=uvs)
+        geometry.uvs[key].index = index
+    for (primitive_type, indexes) in payload["primitives"]:
+        primitive = DrawElements()
+        primitive.type = primitive_type
+        primitive.indexes = indexes
+        geometry.primitives.append(primitive)
+    geometry.groups = OrderedDict()
+    for (key, target, vertexes) in payload["groups"]:
+        group = VertexGroup()
+        group.targetGroupName = target
+        group.vertexes = vertexes
+        geometry.groups[key] = group
+    return (payload["material_index"], geometry)
+
+
+# CONTENT HASH
+# ------------
+def hashCollection(digest, collection, attribute, typecode, size):
+    ''' Feed the raw values of a mesh collection attribute to the digest '''
+    values = array.array(typecode, [0]) * (len(collection) * size)
+    collection.foreach_get(attribute, values)
+    digest.update(values.tobytes())
+
+
+def getMeshKey(blender_object, mesh, config):
+    '''
+    Content hash of the evaluated mesh data, of the object data the conversion
+    depends on and of the config fields changing the converted result
+    '''
+    digest = hashlib.sha1()
+    digest.update(repr((CACHE_VERSION,
+                        config.scale_factor,
+                        config.float_precision,
+                        config.apply_modifiers,
+                        blender_object.name,
+                        [material.name if material else None for material in mesh.materials],
+                        [group.name for group in blender_object.vertex_groups],
+                        [(modifier.type, modifier.object.name) for modifier in blender_object.modifiers
+                         if modifier.type == 'ARMATURE' and modifier.object],
+                        (blender_object.parent.name, blender_object.parent.type, blender_object.parent_bone)
+                        if blender_object.parent else None,
+                        mesh.has_custom_normals,
+                        [layer.name for layer in mesh.uv_layers],
+                        mesh.vertex_colors.active.name if mesh.vertex_colors.active else None)).encode('utf-8'))
+
+    hashCollection(digest, mesh.vertices, "co", 'f', 3)
+    hashCollection(digest, mesh.loops, "vertex_index", 'i', 1)
+    hashCollection(digest, mesh.polygons, "loop_start", 'i', 1)
+    hashCollection(digest, mesh.polygons, "loop_total", 'i', 1)
+    hashCollection(digest, mesh.polygons, "material_index", 'i', 1)
+    hashCollection(digest, mesh.polygons, "use_smooth", 'b', 1)
+    if mesh.has_custom_normals:
+        mesh.calc_normals_split()
+        hashCollection(digest, mesh.loops, "normal", 'f', 3)
+    for layer in mesh.uv_layers:
+        hashCollection(digest, layer.data, "uv", 'f', 2)
+    if mesh.vertex_colors.active:
+        hashCollection(digest, mesh.vertex_colors.active.data, "color", 'f', 4)
+    if blender_object.vertex_groups:
+        digest.update(repr([[(group.group, group.weight) for group in vertex.groups]
+                            for vertex in mesh.vertices]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# DISK CACHE
+# ----------
+class GeometryCache(object):
+    '''
+    Converted geometries stored as compressed pickles in a directory, the least
+    recently used entries are evicted when the directory exceeds max_size bytes
+    '''
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key + CACHE_EXTENSION)
+
+    def load(self, key):
+        ''' Returns the list of (material_index, geometry) stored for key or None '''
+        path = self.getPath(key)
+        try:
+            with open(path, "rb") as cache_file:
+                payloads = pickle.loads(zlib.decompress(cache_file.read()))
+            # touch the entry to keep it recently used
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, ValueError, zlib.error, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [payloadToGeometry(payload) for payload in payloads]
+
+    def store(self, key, geometries):
+        ''' Store a list of (material_index, geometry) for key '''
+        payloads = [geometryToPayload(material_index, geometry) for (material_index, geometry) in geometries]
+        path = self.getPath(key)
+        temporary_path = path + ".tmp"
+        try:
+            with open(temporary_path, "wb") as cache_file:
+                cache_file.write(zlib.compress(pickle.dumps(payloads, pickle.HIGHEST_PROTOCOL)))
+            os.replace(temporary_path, path)
+        except (IOError, OSError) as e:
+            Log("Warning: can't write conversion cache entry {}: {}".format(path, e))
+
+    def evict(self):
+        ''' Remove the least recently used entries until the cache fits in max_size '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(CACHE_EXTENSION):
+                continue
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(entry[1] for entry in entries)
+        for (mtime, size, path) in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+        Log("conversion cache: {} hits, {} misses, {} bytes".format(self.hits, self.misses, total))
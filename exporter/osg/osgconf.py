@@ -58,10 +58,35 @@ class Config(object):
         self.defaultattr("object_selected", None)
 
         self.defaultattr("apply_modifiers", False)
+        self.defaultattr("split_large_geometries", False)
+        self.defaultattr("chunk_large_meshes", False)
+        self.defaultattr("chunk_triangle_count", 16384)
+        self.defaultattr("spatial_hierarchy", False)
+        self.defaultattr("spatial_leaf_size", 8)
+        self.defaultattr("static_batching", False)
+        self.defaultattr("batch_vertex_budget", 65536)
+        self.defaultattr("optimize_scene_graph", False)
+        self.defaultattr("flatten_static_transforms", False)
+        self.defaultattr("share_collection_instances", False)
+        self.defaultattr("share_object_instances", False)
+        self.defaultattr("conversion_cache_dir", "")
+        self.defaultattr("conversion_cache_size", 512)
+        self.defaultattr("live_export", False)
+        self.defaultattr("shard_index", 0)
+        self.defaultattr("shard_count", 1)
         self.defaultattr("bake_animations", False)
         self.defaultattr("use_quaternions", False)
+        self.defaultattr("convert_euler_rotations", False)
         self.defaultattr("bake_constraints", True)
         self.defaultattr("bake_frame_step", 1)
+        self.defaultattr("bake_to_channels", False)
+        self.defaultattr("selective_baking", False)
+        self.defaultattr("prune_constant_channels", False)
+        self.defaultattr("prune_stacked_transforms", False)
+        self.defaultattr("reduce_keyframes", False)
+        self.defaultattr("keyframe_position_tolerance", 0.001)
+        self.defaultattr("keyframe_scale_tolerance", 0.001)
+        self.defaultattr("keyframe_rotation_tolerance", 0.1)
         self.defaultattr("arm_rest", False)
         self.defaultattr("arm_deform_only", True)
         self.defaultattr("osgconv_to_ive", False)
@@ -37,6 +37,9 @@ from .osgutils import *
 from .osgconf import DEBUG
 from . import osgbake
 from . import osgobject
+from . import osganim
+from . import osgoptimize
+from . import osgcache
 from .osgobject import *
 osgobject.VERSION = osg.__version__
 
@@ -47,14 +50,8 @@ Quaternion = mathutils.Quaternion
 Log = osglog.log
 
 
-def createAnimationUpdate(blender_object, callback, rotation_mode, prefix="", zero=False):
-    has_location_keys = False
-    has_scale_keys = False
-    has_rotation_keys = False
-    has_constraints = hasSolidConstraints(blender_object)
-    has_nla = hasNLATracks(blender_object)
-
-    # Use local transform matrix at t=0 to initialize stacked transforms.
+def getFrameZeroLocalMatrix(blender_object):
+    ''' Evaluates the scene at t=0 to read the local matrix of a single object '''
     scene = bpy.context.scene
     backup_frame = scene.frame_current
     scene.frame_set(0)
@@ -65,6 +62,15 @@ def createAnimationUpdate(blender_object, callback, rotation_mode, prefix="", ze
 
     scene.frame_set(backup_frame)
     bpy.context.view_layer.update()
+    return lcl_transform
+
+
+def createAnimationUpdate(blender_object, callback, rotation_mode, prefix="", zero=False, lcl_transform=None):
+    has_location_keys = False
+    has_scale_keys = False
+    has_rotation_keys = False
+    has_constraints = hasSolidConstraints(blender_object)
+    has_nla = hasNLATracks(blender_object)
 
     if blender_object.animation_data:
         action = blender_object.animation_data.action
@@ -85,6 +91,10 @@ def createAnimationUpdate(blender_object, callback, rotation_mode, prefix="", ze
     if not (has_location_keys or has_scale_keys or has_rotation_keys) and not has_constraints and not has_nla:
         return None
 
+    # Use local transform matrix at t=0 to initialize stacked transforms.
+    if lcl_transform is None and not zero:
+        lcl_transform = getFrameZeroLocalMatrix(blender_object)
+
     if zero:
         if has_location_keys:
             tr = StackedTranslateElement()
@@ -197,6 +207,80 @@ class UniqueObject(object):
         self.statesets[obj] = reg
 
 
+class SceneIndex(object):
+    '''
+    Lookup tables built once per export to avoid scanning the scene
+    or the osg tree for each exported object
+    '''
+    def __init__(self, scene=None):
+        self.children = {}
+        self.bones = {}
+        self.blender_objects = {}
+        if scene is not None:
+            self.build(scene)
+
+    def build(self, scene):
+        self.children = {}
+        for obj in scene.objects:
+            self.children.setdefault(obj.parent, []).append(obj)
+
+    def getChildren(self, blender_object):
+        return self.children.get(blender_object, [])
+
+    def registerSkeleton(self, skeleton):
+        self.bones.update(skeleton.boneDict)
+
+    def getBone(self, bonename):
+        return self.bones.get(bonename, None)
+
+    def registerObject(self, blender_object, osg_object):
+        self.blender_objects.setdefault(osg_object, blender_object)
+
+    def getBlenderObject(self, osg_object):
+        return self.blender_objects.get(osg_object, None)
+
+
+class TransformSnapshot(object):
+    '''
+    Local matrices at t=0 and pose space bone matrices captured with a
+    single scene evaluation instead of one evaluation per exported object
+    '''
+    def __init__(self):
+        self.local_matrices = {}
+        self.pose_matrices = {}
+
+    def capture(self, scene, rest_armatures, objects=None):
+        self.local_matrices = {}
+        self.pose_matrices = {}
+
+        # Armatures the exporter put in rest mode are read in pose mode,
+        # the other ones keep the position chosen by the user
+        if rest_armatures:
+            setArmaturesPosePosition(scene, 'POSE', rest_armatures)
+        if objects is None:
+            objects = scene.objects
+        for obj in objects:
+            if obj.type == 'ARMATURE' and obj.pose:
+                self.pose_matrices[obj] = dict((pose_bone.name, pose_bone.matrix.copy())
+                                               for pose_bone in obj.pose.bones)
+        if rest_armatures:
+            setArmaturesPosePosition(scene, 'REST', rest_armatures)
+
+        backup_frame = scene.frame_current
+        scene.frame_set(0)
+        bpy.context.view_layer.update()
+        for obj in objects:
+            self.local_matrices[obj] = obj.matrix_local.copy()
+        scene.frame_set(backup_frame)
+        bpy.context.view_layer.update()
+
+    def getLocalMatrix(self, blender_object):
+        return self.local_matrices.get(blender_object, None)
+
+    def getPoseMatrices(self, armature):
+        return self.pose_matrices.get(armature, None)
+
+
 class Export(object):
     def __init__(self, config=None):
         object.__init__(self)
@@ -213,7 +297,22 @@ class Export(object):
         self.lights = {}
         self.root = None
         self.unique_objects = UniqueObject()
+        self.scene_index = SceneIndex()
+        self.snapshot = TransformSnapshot()
+        self.collection_groups = {}
+        self.evaluated_meshes = {}
+        # (blender object, mesh, modifier stack signature or None) -> geode
+        self.converted_geodes = {}
+        # root blender object -> exported item, and channels added by each object, for patch()
+        self.root_items = OrderedDict()
+        self.object_channels = {}
+        self.exported_parents = {}
+        # passes transforming the whole graph, a graph they ran on can't be patched
+        self.graph_passes = True
+        self.patchable = False
+        self.geometry_cache = None
         self.parse_all_actions = False  # if only one object and several actions
+        self.bake_scheduler = None
 
     def clean_generated_actions(self):
         for action in self.baked_actions:
@@ -225,6 +324,211 @@ class Export(object):
             except:
                 Log('Can''t remove generated action')
 
+    def retainConversions(self, previous, changed):
+        '''
+        Reuse the geodes, statesets and textures converted by a previous export
+        when none of the datablocks they were built from are in changed
+        '''
+        # flattening bakes transforms into the geometries, they can't be reused
+        if self.config.optimize_scene_graph and self.config.flatten_static_transforms:
+            return
+        (statesets, textures, geodes) = previous.getValidConversions(changed)
+        for (source, stateset) in statesets.items():
+            self.unique_objects.registerStateSet(source, stateset)
+        for (node, texture) in textures.items():
+            self.unique_objects.registerTexture(node, texture)
+        self.converted_geodes = geodes
+
+    def getValidConversions(self, changed):
+        ''' Returns the (statesets, textures, geodes) of this export built from unchanged datablocks '''
+        shading_changed = any(isinstance(data, (bpy.types.NodeTree, bpy.types.Image)) for data in changed)
+        statesets = {}
+        stale_statesets = set()
+        for (source, stateset) in self.unique_objects.statesets.items():
+            if shading_changed or source in changed:
+                stale_statesets.add(stateset)
+            else:
+                statesets[source] = stateset
+        textures = {} if shading_changed else dict(self.unique_objects.textures)
+
+        def isStale(geode):
+            drawables = getattr(geode, "drawables", [])
+            if any(drawable.stateset in stale_statesets for drawable in drawables):
+                return True
+            # chunked geodes are groups of geodes
+            return any(isStale(child) for child in getattr(geode, "children", []))
+
+        # geodes also depend on the object they were converted for: names, vertex groups,
+        # armature, object linked materials, so any update of the object invalidates them
+        geodes = {}
+        for (key, geode) in self.converted_geodes.items():
+            (blender_object, mesh, signature) = key
+            if blender_object in changed or mesh in changed or isStale(geode):
+                continue
+            if signature is not None and any(item in changed for item in signature):
+                continue
+            geodes[key] = geode
+        return (statesets, textures, geodes)
+
+    def isChanged(self, blender_object, changed):
+        ''' Whether an object or one of the datablocks its conversion reads is in changed '''
+        if blender_object in changed or blender_object.data in changed:
+            return True
+        if blender_object.instance_collection is not None and blender_object.instance_collection in changed:
+            return True
+        if hasAction(blender_object) and blender_object.animation_data.action in changed:
+            return True
+        if hasShapeKeys(blender_object) and blender_object.data.shape_keys in changed:
+            return True
+        return any(slot.material in changed for slot in blender_object.material_slots if slot.material)
+
+    def getCollectionObjects(self, blender_object):
+        ''' The objects of the collections instanced by an object, nested instances included '''
+        objects = []
+        stack = [blender_object]
+        visited = set()
+        while stack:
+            instancer = stack.pop()
+            collection = instancer.instance_collection if instancer.instance_type == 'COLLECTION' else None
+            if collection is None or collection in visited:
+                continue
+            visited.add(collection)
+            objects.extend(collection.all_objects)
+            stack.extend(collection.all_objects)
+        return objects
+
+    def removeNodes(self, node, nodes, visited):
+        ''' Remove nodes from the children lists of the graph, keeping the lists themselves '''
+        if id(node) in visited:
+            return
+        visited.add(id(node))
+        children = getattr(node, "children", None)
+        if not children:
+            return
+        children[:] = [child for child in children if child not in nodes]
+        for child in children:
+            self.removeNodes(child, nodes, visited)
+
+    def patch(self, changed):
+        '''
+        Export again the roots holding changed objects and replace their subtrees in the
+        scene graph of the previous process(), conversions of unchanged datablocks are kept.
+        Returns False when the change needs a full export instead: graphs transformed by the
+        whole graph passes, added or removed roots, lights, several exported actions...
+        '''
+        if not self.patchable or self.root is None:
+            return False
+        if any(isinstance(data, (bpy.types.NodeTree, bpy.types.Image)) for data in changed) or \
+           (self.lights and any(isinstance(data, bpy.types.World) for data in changed)):
+            return False
+        scene = self.config.scene
+        self.scene_index.build(scene)
+        roots = self.getRoots()
+        if roots != list(self.root_items.keys()) or self.hasSingleAnimatedObject():
+            return False
+
+        subtrees = dict((root, self.collectObjects([root])) for root in roots)
+        # added, removed or reparented objects
+        parents = dict((obj, obj.parent) for root in roots for obj in subtrees[root])
+        if parents != self.exported_parents:
+            return False
+        collections = dict((root, [o for obj in subtrees[root] for o in self.getCollectionObjects(obj)])
+                           for root in roots)
+        changed_objects = set(obj for root in roots for obj in subtrees[root] + collections[root]
+                              if self.isChanged(obj, changed))
+        if not changed_objects:
+            return True
+        # members of unchanged collections keep their nodes, shared by every instance
+        stale_collections = set(c for c in self.collection_groups
+                                if any(obj in changed_objects for obj in c.all_objects))
+        stale_members = set()
+        for root in roots:
+            for obj in subtrees[root]:
+                members = self.getCollectionObjects(obj)
+                if any(member in changed_objects for member in members):
+                    stale_members.update(members)
+
+        # roots sharing stale objects, or linked by an armature modifier, are exported together
+        root_of = dict((obj, root) for root in roots for obj in subtrees[root])
+        affected = set(root for root in roots
+                       if any(obj in changed_objects for obj in subtrees[root] + collections[root]))
+        grow = True
+        while grow:
+            grow = False
+            stale = set(obj for root in affected for obj in subtrees[root]) | stale_members
+            for root in roots:
+                linked = set(root_of[modifier.object] for obj in subtrees[root]
+                             for modifier in getattr(obj, "modifiers", [])
+                             if modifier.type == 'ARMATURE' and modifier.object in root_of)
+                if root not in affected and (linked & affected or stale & set(collections[root])):
+                    affected.add(root)
+                    grow = True
+                elif root in affected and not linked <= affected:
+                    affected |= linked
+                    grow = True
+        stale = [obj for root in roots if root in affected for obj in subtrees[root]] + list(stale_members)
+        if any(obj.type == 'LIGHT' for obj in stale):
+            return False
+        Log("live export: patching {} of {} roots".format(len(affected), len(roots)))
+
+        self.config.createLogfile()
+        (statesets, textures, geodes) = self.getValidConversions(changed)
+        self.unique_objects.statesets = statesets
+        self.unique_objects.textures = textures
+        self.converted_geodes = geodes
+        for collection in stale_collections:
+            del self.collection_groups[collection]
+
+        stale_nodes = set()
+        stale_channels = set()
+        meshes = set()
+        for obj in stale:
+            node = self.unique_objects.objects.pop(obj, None)
+            if node is not None:
+                stale_nodes.add(node)
+                self.scene_index.blender_objects.pop(node, None)
+            if obj.data is not None:
+                # converted again or taken back from converted_geodes
+                self.unique_objects.objects.pop(obj.data, None)
+                meshes.add(obj.data)
+            stale_channels.update(self.object_channels.pop(obj, []))
+        self.evaluated_meshes = dict((key, geode) for (key, geode) in self.evaluated_meshes.items()
+                                     if key[0] not in meshes)
+        self.removeNodes(self.root, stale_nodes, set())
+        for animation in self.animations:
+            animation.channels = [channel for channel in animation.channels if channel not in stale_channels]
+
+        patched = Group()
+        self.rest_armatures = setArmaturesPosePosition(scene, 'REST',
+                                                       [obj for obj in stale if obj.type == 'ARMATURE']) \
+            if any(obj.type == 'ARMATURE' for obj in stale) else []
+        try:
+            self.snapshot.capture(scene, self.rest_armatures, stale)
+            if self.config.export_anim:
+                self.bake_scheduler = osgbake.BakeScheduler(scene,
+                                                            self.collectObjects([r for r in roots if r in affected]),
+                                                            self.config.bake_frame_step)
+            for root in roots:
+                if root in affected:
+                    item = self.exportChildrenRecursively(root, None, None)
+                    self.root_items[root] = item
+                    if item is not None:
+                        patched.children.append(item)
+        finally:
+            self.restoreArmaturePoseMode()
+            self.clean_generated_actions()
+            if self.geometry_cache is not None:
+                self.geometry_cache.evict()
+
+        self.postProcessAnimations(patched, [channel for obj in stale
+                                             for channel in self.object_channels.get(obj, [])])
+        self.reparentRiggedGeodes(patched, None)
+        order = dict((id(item), index) for (index, item) in enumerate(self.root_items.values()))
+        self.items.extend(patched.children)
+        self.items.sort(key=lambda item: order.get(id(item), len(order)))
+        self.collectImages()
+        return True
+
     def isExcluded(self, blender_object):
         return blender_object.name in self.config.exclude_objects
 
@@ -237,6 +541,7 @@ class Export(object):
 
     def exportItemAndChildren(self, blender_object):
         item = self.exportChildrenRecursively(blender_object, None, None)
+        self.root_items[blender_object] = item
         if item is not None:
             self.items.append(item)
 
@@ -252,6 +557,10 @@ class Export(object):
         group.matrix = Matrix.Translation(-blender_object.instance_collection.instance_offset)
         item.children.append(group)
 
+        if self.config.share_collection_instances:
+            group.children.append(self.getSharedCollection(blender_object.instance_collection, rootItem))
+            return
+
         # for group we disable the only visible
         config_visible = self.config.only_visible
         self.config.only_visible = False
@@ -261,21 +570,120 @@ class Export(object):
         self.config.only_visible = config_visible
         # and restore it after processing group
 
+    def getSharedCollection(self, collection, rootItem):
+        '''
+        Converts an instanced collection only once, every instance references
+        the same group which is then written once and reused by UniqueID
+        '''
+        shared = self.collection_groups.get(collection, None)
+        if shared is not None:
+            Log("collection {} has already been parsed, reuse it".format(collection.name))
+            return shared
+
+        shared = Group()
+        shared.setName(collection.name)
+        self.collection_groups[collection] = shared
+
+        config_visible = self.config.only_visible
+        self.config.only_visible = False
+        for o in collection.objects:
+            # children are exported with their parent
+            if o.parent is not None and o.parent.name in collection.objects:
+                continue
+            Log("object {}".format(o))
+            self.exportChildrenRecursively(o, shared, rootItem)
+        self.config.only_visible = config_visible
+        return shared
+
+    def exportObjectInstances(self):
+        '''
+        Export the instances generated by the dependency graph (vertices, faces,
+        particles, geometry nodes) as transforms referencing a geode converted
+        once per instanced object, nothing is made real in the blend file.
+        Instanced empties and cameras are plain transforms, the objects of the
+        collections they instance are instances of their own. Geometry instanced
+        by geometry nodes has no object of its own, it is converted once per
+        evaluated mesh
+        '''
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        instances = []
+        skipped = set()
+        geometries = {}
+        for instance in depsgraph.object_instances:
+            if not instance.is_instance or instance.parent is None:
+                continue
+            instancer = instance.parent.original
+            source = instance.object.original
+            # collection instances are handled by evaluateCollection
+            if instancer.instance_type == 'COLLECTION':
+                continue
+            if source == instancer:
+                # instances and their evaluated data are only valid during the iteration
+                data = instance.object.data
+                if not isinstance(data, bpy.types.Mesh):
+                    skipped.add("{} geometry".format(instancer.name))
+                    continue
+                if data not in geometries and self.unique_objects.hasObject(instancer):
+                    geometries[data] = self.createGeodeFromMesh(instancer, data, None, False)
+                instances.append((instancer, source, instance.matrix_world.copy(), geometries.get(data)))
+                continue
+            if source.type not in ['MESH', 'EMPTY', 'LIGHT', 'CAMERA']:
+                skipped.add(source.name)
+                continue
+            instances.append((instancer, source, instance.matrix_world.copy(), None))
+
+        shared = {}
+        for (index, (instancer, source, matrix, geode)) in enumerate(instances):
+            parent = self.unique_objects.getObject(instancer)
+            if parent is None or self.isExcluded(source):
+                continue
+
+            item = MatrixTransform()
+            item.setName("{}_instance".format(source.name))
+            item.matrix = instancer.matrix_world.inverted_safe() @ matrix
+            item.matrix.translation *= self.config.scale_factor
+            if geode is not None:
+                item.children.append(geode)
+            elif source.type == 'MESH':
+                geode = shared.get(source, None)
+                if geode is None:
+                    geode = self.createGeodeFromObject(source)
+                    shared[source] = geode
+                item.children.append(geode)
+            elif source.type == 'LIGHT':
+                # each instance is a light of its own
+                light = BlenderLightToLightSource(light=source).convert()
+                light.setName("{}_instance{}".format(source.name, index))
+                self.lights[light.name] = light
+                item.children.append(light)
+            parent.children.append(item)
+
+        if instances:
+            Log("{} instances of {} objects and {} geometries exported as references"
+                .format(len(instances), len(shared), len(geometries)))
+        if skipped:
+            Log("Warning: [[blender]] Skipping instances of {} (only meshes, empties, lights and cameras "
+                "instances are exported)".format(", ".join(sorted(skipped))))
+
     def getName(self, blender_object):
         if hasattr(blender_object, "name"):
             return blender_object.name
         return "no name"
 
-    def createAnimationsObject(self, osg_object, blender_object, config, update_callback, unique_objects,parse_all_actions=False):
+    def createUpdateCallback(self, osg_object, blender_object, rotation_mode):
+        return createAnimationUpdate(blender_object,
+                                     UpdateMatrixTransform(name=osg_object.name),
+                                     rotation_mode,
+                                     lcl_transform=self.snapshot.getLocalMatrix(blender_object))
+
+    def createAnimationsObject(self, osg_object, blender_object, config, rotation_mode, unique_objects,
+                               parse_all_actions=False):
         if not config.export_anim or len(bpy.data.actions) == 0:
             return None
         has_action = blender_object.animation_data and hasAction(blender_object)
         has_constraints = hasSolidConstraints(blender_object) or hasExternalBoneConstraints(blender_object)
         has_morph = hasShapeKeysAnimation(blender_object)
 
-        if blender_object.type != 'ARMATURE' and not has_morph and not update_callback:
-            return None
-
         if not has_action and not has_constraints and not has_morph and not hasNLATracks(blender_object):
             return None
 
@@ -285,12 +693,18 @@ class Export(object):
         if has_constraints and (blender_object.parent and blender_object.parent.type == 'ARMATURE'):
             return None
 
+        # the callback is only built for objects that are actually animated
+        update_callback = self.createUpdateCallback(osg_object, blender_object, rotation_mode)
+        if blender_object.type != 'ARMATURE' and not has_morph and not update_callback:
+            return None
+
         action2animation = BlenderAnimationToAnimation(object=blender_object,
                                                        config=config,
                                                        unique_objects=unique_objects,
                                                        has_action=has_action,
                                                        has_constraints=has_constraints,
-                                                       has_morph=has_morph)
+                                                       has_morph=has_morph,
+                                                       bake_scheduler=self.bake_scheduler)
 
         if parse_all_actions:
             self.animations = action2animation.parseAllActions()
@@ -300,6 +714,7 @@ class Export(object):
                 self.current_animation = Animation()
                 self.current_animation.setName('Take 01')
                 self.animations.append(self.current_animation)
+            first_channel = len(self.current_animation.channels)
             action2animation.handleAnimationBaking()
             action2animation.addActionDataToAnimation(self.current_animation)
 
@@ -307,6 +722,7 @@ class Export(object):
                 # Bake morph animation
                 action2animation.handleMorphAnimationBaking()
                 action2animation.addActionDataToAnimation(self.current_animation, morph=True)
+            self.object_channels[blender_object] = self.current_animation.channels[first_channel:]
 
         # Remove actions created by the exporter for baking
         self.baked_actions.extend(action2animation.get_generated_actions())
@@ -356,9 +772,7 @@ class Export(object):
         def parseArmature(blender_armature):
             osg_object = self.createSkeleton(blender_object)
             self.createAnimationsObject(osg_object, blender_object, self.config,
-                                        createAnimationUpdate(blender_object,
-                                                              UpdateMatrixTransform(name=osg_object.name),
-                                                              rotation_mode),
+                                        rotation_mode,
                                         self.unique_objects,
                                         self.parse_all_actions)
             
@@ -377,9 +791,7 @@ class Export(object):
             
             lightItem = self.createLight(blender_object)
             self.createAnimationsObject(osg_object, blender_object, self.config,
-                                        createAnimationUpdate(blender_object,
-                                                              UpdateMatrixTransform(name=osg_object.name),
-                                                              rotation_mode),
+                                        rotation_mode,
                                         self.unique_objects,
                                         self.parse_all_actions)
             osg_object.children.append(lightItem)
@@ -407,9 +819,7 @@ class Export(object):
             osg_object.matrix.translation *= self.config.scale_factor
 
             self.createAnimationsObject(osg_object, blender_object, self.config,
-                                        createAnimationUpdate(blender_object,
-                                                              UpdateMatrixTransform(name=osg_object.name),
-                                                              rotation_mode),
+                                        rotation_mode,
                                         self.unique_objects,
                                         self.parse_all_actions)
 
@@ -422,24 +832,21 @@ class Export(object):
             return osg_object
 
         def handleBoneChild(blender_object, osg_object):
-            bone = findBoneInHierarchy(osg_root, spaceSafe(blender_object.parent_bone + '_' +
-                                                           str(blender_object.parent.name)))
+            bone = self.scene_index.getBone(spaceSafe(blender_object.parent_bone + '_' +
+                                                      str(blender_object.parent.name)))
             if bone is None:
                 Log("Warning: [[blender]] {} not found".format(blender_object.parent_bone))
             else:
+                # the rest pose matrix of the bone is its armature space matrix,
+                # no need to switch the armature to rest position
                 armature = blender_object.parent
-                original_pose_position = armature.data.pose_position
-                armature.data.pose_position = 'REST'
-
-                boneInWorldSpace = armature.matrix_world @ armature.pose.bones[blender_object.parent_bone].matrix
+                boneInWorldSpace = armature.matrix_world @ armature.data.bones[blender_object.parent_bone].matrix_local
 
                 matrix = getDeltaMatrixFromMatrix(boneInWorldSpace, blender_object.matrix_world)
 
                 osg_object.matrix = matrix
                 bone.children.append(osg_object)
 
-                armature.data.pose_position = original_pose_position
-
         # We skip the object if it is in the excluded objects list
         if self.isExcluded(blender_object):
             return None
@@ -452,7 +859,10 @@ class Export(object):
         Log("")
 
         osg_object = None
-        rotation_mode = 'QUATERNION' if self.config.use_quaternions else blender_object.rotation_mode
+        rotation_mode = blender_object.rotation_mode
+        if self.config.use_quaternions or \
+           (self.config.convert_euler_rotations and rotation_mode not in ['QUATERNION', 'AXIS_ANGLE']):
+            rotation_mode = 'QUATERNION'
 
         if self.unique_objects.hasObject(blender_object):
             Log("{} '{}' has already been parsed, reuse osg_object".format(blender_object.type, blender_object.name))
@@ -471,6 +881,7 @@ class Export(object):
                 return None
 
             self.unique_objects.registerObject(blender_object, osg_object)
+            self.scene_index.registerObject(blender_object, osg_object)
 
         if osg_root is None:
             osg_root = osg_object
@@ -481,7 +892,7 @@ class Export(object):
         elif parent:
             parent.children.append(osg_object)
 
-        children = getChildrenOf(self.config.scene, blender_object)
+        children = self.scene_index.getChildren(blender_object)
         for child in children:
             self.exportChildrenRecursively(child, osg_object, osg_root)
         return osg_object
@@ -492,7 +903,10 @@ class Export(object):
         use_pose = not (hasAction(blender_object) or hasNLATracks(blender_object)) and not \
             (hasExternalBoneConstraints(blender_object)) and not self.config.arm_rest
 
-        if use_pose and blender_object in self.rest_armatures:
+        pose_matrices = self.snapshot.getPoseMatrices(blender_object) if use_pose else None
+        # armatures outside of the snapshot are switched to pose mode here
+        toggle_pose = use_pose and pose_matrices is None and blender_object in self.rest_armatures
+        if toggle_pose:
             setArmaturesPosePosition(self.config.scene, 'POSE', [blender_object])
 
         matrix = getDeltaMatrixFrom(blender_object.parent, blender_object)
@@ -510,30 +924,29 @@ class Export(object):
                 b = Bone(blender_object, bone)
                 b.buildBoneChildren(use_pose=use_pose,
                                     scale_factor=self.config.scale_factor,
-                                    deform_only=self.config.arm_deform_only
-                                    )
+                                    deform_only=self.config.arm_deform_only,
+                                    pose_matrices=pose_matrices)
                 skeleton.children.append(b)        
         skeleton.collectBones()
+        self.scene_index.registerSkeleton(skeleton)
 
-        if use_pose and blender_object in self.rest_armatures:
+        if toggle_pose:
             setArmaturesPosePosition(self.config.scene, 'REST', [blender_object])
         return skeleton
 
-    def preProcess(self):
-        def lookForAnimatedObjects():
-            scene = self.config.scene
-            nb_animated_objects = 0
-            for obj in scene.objects:
-                # FIXME not sure about the constraint check here
-                if hasAction(obj) or \
-                   hasSolidConstraints(obj) or \
-                   hasExternalBoneConstraints(obj) or \
-                   hasNLATracks(obj) or \
-                   hasShapeKeysAnimation(obj):
-                    nb_animated_objects += 1
-
-            self.parse_all_actions = nb_animated_objects == 1
+    def hasSingleAnimatedObject(self):
+        nb_animated_objects = 0
+        for obj in self.config.scene.objects:
+            # FIXME not sure about the constraint check here
+            if hasAction(obj) or \
+               hasSolidConstraints(obj) or \
+               hasExternalBoneConstraints(obj) or \
+               hasNLATracks(obj) or \
+               hasShapeKeysAnimation(obj):
+                nb_animated_objects += 1
+        return nb_animated_objects == 1
 
+    def preProcess(self):
         def checkNameEncoding(elements, label, renamed_count):
             for element in elements:
                 try:
@@ -584,9 +997,11 @@ class Export(object):
         # we need to save it
         backup_selection = bpy.context.selected_objects
 
-        make_dupliverts_real(self.config.scene)
+        if not self.config.share_object_instances:
+            make_dupliverts_real(self.config.scene)
         resolveMisencodedNames(self.config.scene)
-        lookForAnimatedObjects()
+        self.parse_all_actions = self.hasSingleAnimatedObject()
+        self.scene_index.build(self.config.scene)
 
         # restore the user's selection
         unselectAllObjects()
@@ -602,8 +1017,14 @@ class Export(object):
             self.config.filename += self.scene_name
         self.config.createLogfile()
 
+        # a long running process may provide its own cache
+        if self.config.conversion_cache_dir and self.geometry_cache is None:
+            self.geometry_cache = osgcache.GeometryCache(bpy.path.abspath(self.config.conversion_cache_dir),
+                                                         self.config.conversion_cache_size * 1024 * 1024)
+
         self.setArmatureInRestMode()
         try:
+            self.snapshot.capture(self.config.scene, self.rest_armatures)
             if self.config.object_selected is not None:
                 o = bpy.data.objects[self.config.object_selected]
                 try:
@@ -614,17 +1035,113 @@ class Export(object):
                         .format(o.name, self.config.scene.name))
                     raise
 
-            for obj in self.config.scene.objects:
-                Log("obj {}".format(obj.name))
-                if (self.config.selected == "SELECTED_ONLY_WITH_CHILDREN" and obj.select_get()) or \
-                   (self.config.selected == "ALL" and obj.parent is None):
-                    self.exportItemAndChildren(obj)
+            roots = self.getRoots()
+
+            if self.config.export_anim and not self.parse_all_actions:
+                # every bake of a single animation export uses the same frame range
+                self.bake_scheduler = osgbake.BakeScheduler(self.config.scene,
+                                                            self.collectObjects(roots),
+                                                            self.config.bake_frame_step)
+
+            for obj in roots:
+                self.exportItemAndChildren(obj)
+            self.exported_parents = dict((obj, obj.parent) for obj in self.collectObjects(roots))
+
+            if self.config.share_object_instances:
+                self.exportObjectInstances()
         finally:
             self.restoreArmaturePoseMode()
             self.clean_generated_actions()
+            if self.geometry_cache is not None:
+                self.geometry_cache.evict()
 
         self.postProcess()
 
+    def getRoots(self):
+        roots = []
+        for obj in self.config.scene.objects:
+            Log("obj {}".format(obj.name))
+            if (self.config.selected == "SELECTED_ONLY_WITH_CHILDREN" and obj.select_get()) or \
+               (self.config.selected == "ALL" and obj.parent is None):
+                roots.append(obj)
+
+        if self.config.shard_count > 1:
+            roots = self.selectShardRoots(roots)
+        return roots
+
+    def collectObjects(self, roots):
+        ''' Returns the roots and all their descendants '''
+        objects = []
+        stack = list(reversed(roots))
+        while stack:
+            blender_object = stack.pop()
+            objects.append(blender_object)
+            stack.extend(self.scene_index.getChildren(blender_object))
+        return objects
+
+    def selectShardRoots(self, roots):
+        '''
+        Partition the roots by estimated cost between config.shard_count exports and
+        return the ones of config.shard_index. Roots linked by an armature modifier
+        are kept together, lights, even instanced by a collection, stay in the first
+        shard to keep their numbering
+        '''
+        root_set = set(roots)
+
+        def getRoot(blender_object):
+            while blender_object is not None and blender_object not in root_set:
+                blender_object = blender_object.parent
+            return blender_object
+
+        groups = dict((root, [root]) for root in roots)
+        group_of = dict((root, root) for root in roots)
+
+        def union(a, b):
+            a, b = group_of[a], group_of[b]
+            if a == b:
+                return
+            for root in groups[b]:
+                group_of[root] = a
+            groups[a].extend(groups.pop(b))
+
+        def instancesLights(blender_object, visited):
+            collection = blender_object.instance_collection if blender_object.instance_type == 'COLLECTION' else None
+            if collection is None or collection in visited:
+                return False
+            visited.add(collection)
+            return any(o.type == 'LIGHT' or instancesLights(o, visited) for o in collection.all_objects)
+
+        costs = dict((root, 0) for root in roots)
+        pinned = set()
+        for root in roots:
+            stack = [root]
+            while stack:
+                blender_object = stack.pop()
+                costs[root] += estimateExportCost(blender_object)
+                if blender_object.type == 'LIGHT' or instancesLights(blender_object, set()):
+                    pinned.add(root)
+                for modifier in getattr(blender_object, "modifiers", []):
+                    if modifier.type == 'ARMATURE' and getRoot(modifier.object) is not None:
+                        union(root, getRoot(modifier.object))
+                stack.extend(self.scene_index.getChildren(blender_object))
+
+        order = dict((root, index) for (index, root) in enumerate(roots))
+        loads = [0] * self.config.shard_count
+        shard_of = {}
+        # largest groups first, each one goes to the least loaded shard
+        for (key, members) in sorted(groups.items(),
+                                     key=lambda item: (-sum(costs[root] for root in item[1]), order[item[0]])):
+            if any(root in pinned for root in members):
+                shard = 0
+            else:
+                shard = loads.index(min(loads))
+            loads[shard] += sum(costs[root] for root in members)
+            for root in members:
+                shard_of[root] = shard
+
+        Log("shard {}/{} estimated costs {}".format(self.config.shard_index, self.config.shard_count, loads))
+        return [root for root in roots if shard_of[root] == self.config.shard_index]
+
     # OSG requires that rig geometry be a child of the skeleton,
     # but Blender does not.  Move any meshes that are modified by
     # an armature to be under the armature.
@@ -638,14 +1155,14 @@ class Export(object):
 
             # some blend files has a armature_modifier but a None object
             # so we have to test armature_modifier and armature_modifier.object
-            if geode.armature_modifier is not None and geode.armature_modifier.object:
+            # depsgraph instances have no blender object of their own and stay in place
+            if geode.armature_modifier is not None and geode.armature_modifier.object and \
+               self.scene_index.getBlenderObject(item) is not None:
                 parent.children.remove(item)
                 modifier_object = item.children[0].armature_modifier.object
 
                 arm = self.unique_objects.getObject(modifier_object)
-                for (k, v) in self.unique_objects.objects.items():
-                    if v == item:
-                        meshobj = k
+                meshobj = self.scene_index.getBlenderObject(item)
 
                 item.matrix = getDeltaMatrixFromMatrix(item.children[0].armature_modifier.object.matrix_world,
                                                        meshobj.matrix_world)
@@ -662,13 +1179,31 @@ class Export(object):
         self.root = Group()
         self.root.setName("Root")
         self.root.children = self.items
-        if len(self.animations) > 0:
-            animation_manager = BasicAnimationManager()
-            animation_manager.animations = self.animations
-            self.root.update_callbacks.append(animation_manager)
+        self.postProcessAnimations(self.root, [channel for animation in self.animations
+                                               for channel in animation.channels])
 
         self.reparentRiggedGeodes(self.root, None)
 
+        graph_passes = self.graph_passes and (self.config.static_batching or
+                                              self.config.optimize_scene_graph or
+                                              self.config.spatial_hierarchy)
+        self.patchable = not graph_passes and not self.parse_all_actions and \
+            not self.config.share_object_instances
+        if not self.graph_passes:
+            Log("whole graph passes are skipped")
+        elif self.config.static_batching:
+            osgoptimize.batchStaticGeodes(self.root,
+                                          self.unique_objects.statesets.values(),
+                                          self.config.batch_vertex_budget,
+                                          [channel.target for animation in self.animations
+                                           for channel in animation.channels])
+
+        if self.graph_passes and self.config.optimize_scene_graph:
+            osgoptimize.optimizeSceneGraph(self.root, flatten=self.config.flatten_static_transforms)
+
+        if self.graph_passes and self.config.spatial_hierarchy:
+            osgoptimize.buildSpatialHierarchy(self.root, self.config.spatial_leaf_size)
+
         # index light num for opengl use and enable them in a stateset
         if len(self.lights) > 0:
             st = StateSet()
@@ -695,6 +1230,36 @@ class Export(object):
                 st.modes[key] = "ON"
                 light_num += 1
 
+        self.collectImages()
+
+    def postProcessAnimations(self, root, channels):
+        ''' Channels passes on the given channels of the animations and the callbacks under root '''
+        if len(self.animations) > 0:
+            if self.config.prune_constant_channels:
+                osganim.pruneConstantChannels(root,
+                                              self.animations,
+                                              self.config.keyframe_position_tolerance,
+                                              self.config.keyframe_scale_tolerance,
+                                              self.config.keyframe_rotation_tolerance)
+            if self.config.reduce_keyframes:
+                # the channels pruned above are not in the animations anymore
+                channels = set(channels)
+                osganim.reduceChannels([channel for animation in self.animations
+                                        for channel in animation.channels if channel in channels],
+                                       self.config.keyframe_position_tolerance,
+                                       self.config.keyframe_scale_tolerance,
+                                       self.config.keyframe_rotation_tolerance)
+            if not any(isinstance(callback, BasicAnimationManager) for callback in self.root.update_callbacks):
+                animation_manager = BasicAnimationManager()
+                animation_manager.animations = self.animations
+                self.root.update_callbacks.append(animation_manager)
+
+        if self.config.prune_stacked_transforms:
+            # after the channels pruning, so constant channels are folded too
+            osganim.pruneStackedTransforms(root, self.animations)
+
+    def collectImages(self):
+        self.images = set()
         for key in self.unique_objects.statesets.keys():
             stateset = self.unique_objects.statesets[key]
             if stateset is not None:  # register images to unpack them at the end
@@ -710,6 +1275,8 @@ class Export(object):
 
         filename = self.config.getFullName("osgt")
         Log("write file to {}".format(filename))
+        # objects kept from a previous export must be fully written again
+        Writer.wrote_elements = {}
         with open(filename, "wb") as sfile:
             # sfile.write(str(self.root).encode('utf-8'))
             self.root.writeFile(sfile)
@@ -818,18 +1385,53 @@ class Export(object):
             exportInfluence = True
 
         # converting to mesh skips shape keys
-        if self.config.apply_modifiers and has_non_armature_modifiers and not hasShapeKeys(mesh):
-            # Blender object and to_mesh() both require to be touched by the dependency graph for this to work
-            dg = bpy.context.evaluated_depsgraph_get()
-            mesh_object = mesh.evaluated_get(dg).to_mesh(preserve_all_data_layers=True, depsgraph=dg)
-        else:
+        if not (self.config.apply_modifiers and has_non_armature_modifiers and not hasShapeKeys(mesh)):
             mesh_object = mesh.data
+            Log("mesh_object is {}".format(mesh_object.name))
+
+            if self.unique_objects.hasObject(mesh_object):
+                return self.unique_objects.getObject(mesh_object)
 
+            key = (mesh, mesh_object, None)
+            geode = self.converted_geodes.get(key, None)
+            if geode is None:
+                geode = self.createGeodeFromMesh(mesh, mesh_object, armature_modifier, exportInfluence)
+            else:
+                Log("{} has not changed since the previous export, reuse geode".format(mesh.name))
+            self.converted_geodes[key] = geode
+            self.unique_objects.registerObject(mesh_object, geode)
+            return geode
+
+        # Evaluated meshes are new datablocks, objects sharing a mesh and a modifier stack
+        # are deduplicated through their signature instead
+        evaluated_key = (mesh.data, getModifierStackSignature(mesh))
+        if evaluated_key in self.evaluated_meshes:
+            Log("evaluated mesh of {} has already been parsed, reuse geode".format(mesh.name))
+            return self.evaluated_meshes[evaluated_key]
+
+        key = (mesh, mesh.data, evaluated_key[1])
+        geode = self.converted_geodes.get(key, None)
+        if geode is not None:
+            Log("{} has not changed since the previous export, reuse geode".format(mesh.name))
+            self.evaluated_meshes[evaluated_key] = geode
+            return geode
+
+        # Blender object and to_mesh() both require to be touched by the dependency graph for this to work
+        dg = bpy.context.evaluated_depsgraph_get()
+        evaluated_object = mesh.evaluated_get(dg)
+        mesh_object = evaluated_object.to_mesh(preserve_all_data_layers=True, depsgraph=dg)
         Log("mesh_object is {}".format(mesh_object.name))
+        try:
+            geode = self.createGeodeFromMesh(mesh, mesh_object, armature_modifier, exportInfluence)
+        finally:
+            # the geode holds copies of the mesh data, release the temporary mesh right away
+            evaluated_object.to_mesh_clear()
 
-        if self.unique_objects.hasObject(mesh_object):
-            return self.unique_objects.getObject(mesh_object)
+        self.evaluated_meshes[evaluated_key] = geode
+        self.converted_geodes[key] = geode
+        return geode
 
+    def createGeodeFromMesh(self, mesh, mesh_object, armature_modifier, exportInfluence):
         hasVertexGroup = False
 
         for vertex in mesh_object.vertices:
@@ -841,8 +1443,11 @@ class Export(object):
         converter = BlenderObjectToGeometry(object=mesh,
                                             mesh=mesh_object,
                                             config=self.config,
-                                            unique_objects=self.unique_objects)
+                                            unique_objects=self.unique_objects,
+                                            geometry_cache=self.geometry_cache)
         sources_geometries = converter.convert()
+        if self.config.split_large_geometries:
+            sources_geometries = osgoptimize.splitLargeGeometries(sources_geometries)
 
         Log("vertex groups {} {} ".format(exportInfluence, hasVertexGroup))
         if exportInfluence and hasVertexGroup:
@@ -901,7 +1506,12 @@ class Export(object):
                         update.addNestedCallback(callback)
 
                 geode.update_callbacks.append(update)
-        self.unique_objects.registerObject(mesh_object, geode)
+
+        # Only static geometries are chunked, deformed ones must stay in a single geode
+        if self.config.chunk_large_meshes and armature_modifier is None and \
+           all(geom.className() == "Geometry" for geom in geode.drawables):
+            geode = osgoptimize.chunkGeode(geode, self.config.chunk_triangle_count)
+
         return geode
 
     def createLight(self, obj):
@@ -995,6 +1605,7 @@ class BlenderObjectToGeometry(object):
         self.unique_objects = kwargs.get("unique_objects", UniqueObject())
         self.geom_type = Geometry
         self.mesh = kwargs.get("mesh", None)
+        self.geometry_cache = kwargs.get("geometry_cache", None)
         self.material_animations = {}
 
     def createTexture2DFromNode(self, node):
@@ -1547,7 +2158,8 @@ class BlenderObjectToGeometry(object):
 
         return geom
 
-    def process(self, mesh):
+    def processMaterials(self, mesh):
+        ''' Returns the list of (material_index, geometry) of the mesh '''
         if bpy.app.version[0] >= 2 and bpy.app.version[1] >= 63:
             mesh.calc_loop_triangles()  # Generates faces of 3
 
@@ -1557,19 +2169,37 @@ class BlenderObjectToGeometry(object):
         if len(mesh.materials) == 0:
             geom = self.createGeometryForMaterialIndex(0, mesh)
             if geom is not None:
-                geometry_list.append(geom)
+                geometry_list.append((0, geom))
         else:
             for material in mesh.materials:
                 # Blender has an operator to split mesh by material (bpy.ops.mesh.separate(type='MATERIAL'))
                 geom = self.createGeometryForMaterialIndex(material_index, mesh)
                 if geom is not None:
-                    geometry_list.append(geom)
+                    geometry_list.append((material_index, geom))
                 material_index += 1
         return geometry_list
 
+    def process(self, mesh):
+        return [geom for (material_index, geom) in self.processMaterials(mesh)]
 
     def convert(self):
-        return self.process(self.mesh)
+        # morph geometries are always converted
+        if self.geometry_cache is None or hasShapeKeys(self.object):
+            return self.process(self.mesh)
+
+        key = osgcache.getMeshKey(self.object, self.mesh, self.config)
+        geometry_list = self.geometry_cache.load(key)
+        if geometry_list is None:
+            geometry_list = self.processMaterials(self.mesh)
+            self.geometry_cache.store(key, geometry_list)
+        else:
+            Log("mesh {} loaded from the conversion cache".format(self.object.name))
+            # statesets are not cached, they are shared with the other geometries
+            for (material_index, geom) in geometry_list:
+                stateset = self.createStateSet(material_index, self.mesh)
+                if stateset is not None:
+                    geom.stateset = stateset
+        return [geom for (material_index, geom) in geometry_list]
 
 
 # =========================================================================== #
@@ -1588,7 +2218,15 @@ class BlenderAnimationToAnimation(object):
         self.has_action = kwargs.get("has_action", False)
         self.has_constraints = kwargs.get("has_constraints", False)
         self.has_morph = kwargs.get("has_morph", False)
+        self.bake_scheduler = kwargs.get("bake_scheduler", None)
+        self.baked_channels = None
+        # (bone names, bake object) when only part of the object is baked
+        self.bake_selection = None
+        self.baked_action = None
+        self.source_action = None
         self.channel_index = 0
+        # action -> {(data_path, array_index): fcurve}
+        self.fcurve_indexes = {}
         if self.object:
             self.target = self.object.name
         else:
@@ -1633,10 +2271,14 @@ class BlenderAnimationToAnimation(object):
         else:
             start, end = getWidestActionDuration(self.config.scene)
 
-        self.current_action = osgbake.bakeMorphTargets(int(start), int(end), self.object)
+        samples = None
+        if self.bake_scheduler and not is_multi_animation:
+            samples = self.bake_scheduler.getSamples(self.object, int(start), int(end), morph=True)
+        self.current_action = osgbake.bakeMorphTargets(int(start), int(end), self.object, samples=samples)
 
     def handleAnimationBaking(self, is_multi_animation=False):
         Log("Exporting animation on object {}".format(self.object.name))
+        self.bake_selection = None
         if self.has_action and not self.current_action:
             self.current_action = self.object.animation_data.action
 
@@ -1653,6 +2295,35 @@ class BlenderAnimationToAnimation(object):
                 # Bake using widest time range to have short animations looping
                 start, end = getWidestActionDuration(self.config.scene)
 
+            bones = None
+            do_object = True
+            if self.config.selective_baking and not self.config.bake_animations and \
+               not hasNLATracks(self.object):
+                self.source_action = self.object.animation_data.action if self.has_action else None
+                bones, do_object = osgbake.getBakeSelection(self.object, self.source_action)
+                Log("baking {} bones{} of {}".format(len(bones), " and the object" if do_object else "",
+                                                     self.object.name))
+                if not bones and not do_object:
+                    self.action_name = self.source_action.name if self.source_action else 'Action_baked'
+                    return
+                self.bake_selection = (bones, do_object)
+                self.baked_action = None
+
+            samples = None
+            if self.bake_scheduler and not is_multi_animation:
+                samples = self.bake_scheduler.getSamples(self.object, int(start), int(end),
+                                                         self.config.bake_frame_step)
+
+            if self.config.bake_to_channels:
+                if samples is None:
+                    scheduler = osgbake.BakeScheduler(self.config.scene, [self.object], self.config.bake_frame_step)
+                    samples = scheduler.getSamples(self.object, int(start), int(end), self.config.bake_frame_step)
+                if samples is not None:
+                    frame_range = range(int(start), int(end) + 1, self.config.bake_frame_step)
+                    self.baked_channels = self.bakeChannels(samples, frame_range, bones, do_object)
+                    self.action_name = self.object.animation_data.action.name if self.has_action else 'Action_baked'
+                    return
+
             print('BAKING animation for action')
             self.current_action = osgbake.bakeAnimation(self.config.scene,
                                                         int(start),
@@ -1661,8 +2332,12 @@ class BlenderAnimationToAnimation(object):
                                                         self.object,
                                                         use_quaternions=self.config.use_quaternions,
                                                         has_action=self.has_action,
-                                                        deform_only=self.config.arm_deform_only)
+                                                        deform_only=self.config.arm_deform_only,
+                                                        samples=samples,
+                                                        bones=bones,
+                                                        do_object=do_object)
             self.baked_actions.append(self.current_action)
+            self.baked_action = self.current_action
         self.action_name = self.object.animation_data.action.name if self.has_action else 'Action_baked'
 
     def parseAllActions(self):
@@ -1723,6 +2398,14 @@ class BlenderAnimationToAnimation(object):
         return anims
 
     def addActionDataToAnimation(self, animation, morph=False):
+        if not morph and self.baked_channels is not None:
+            animation.channels.extend(self.baked_channels)
+            self.baked_channels = None
+            if self.bake_selection is None:
+                return
+        if not morph and self.bake_selection is not None:
+            self.appendBakeSelectionChannels(animation)
+            return
         if not self.current_action:
             return
         Log('adding data from action {} to animation {}'.format(self.current_action.name, animation))
@@ -1750,6 +2433,21 @@ class BlenderAnimationToAnimation(object):
         else:
             self.appendChannelsToAnimation(self.target, animation, self.current_action)
 
+    def appendBakeSelectionChannels(self, animation):
+        ''' Baked bones use the baked channels or action, the others keep the keys of the source action '''
+        bones, do_object = self.bake_selection
+        if self.object.type == "ARMATURE":
+            for bone in self.object.data.bones:
+                action = self.baked_action if bone.name in bones else self.source_action
+                if action:
+                    osg_target = spaceSafe('{}_{}'.format(bone.name, self.object.name))
+                    self.appendChannelsToAnimation(bone.name, animation, action,
+                                                   prefix=('pose.bones["{}"].'.format(bone.name)),
+                                                   osg_targetname=osg_target)
+        action = self.baked_action if do_object else self.source_action
+        if action:
+            self.appendChannelsToAnimation(self.target, animation, action)
+
     def appendChannelsToAnimation(self, target, anim, action, prefix="", osg_targetname=''):
         channels = self.exportActionsToKeyframeSplitRotationTranslationScale(target,
                                                                              action,
@@ -1762,28 +2460,115 @@ class BlenderAnimationToAnimation(object):
     def get_generated_actions(self):
         return self.baked_actions
 
+    def bakeChannels(self, samples, frame_range, bones=None, do_object=True):
+        ''' Decompose the sampled local matrices into channels without going through an action '''
+        fps = self.config.anim_fps
+        times = [f / fps for f in frame_range]
+        channels = []
+        if self.object.pose is not None:
+            poses = samples.select(samples.pose[self.object], frame_range)
+            for bone in self.object.data.bones:
+                if self.config.arm_deform_only and not isDeform(bone):
+                    continue
+                if bones is not None and bone.name not in bones:
+                    continue
+                # Quaternions are forced for bones
+                channels.extend(self.createTransformChannels(spaceSafe('{}_{}'.format(bone.name, self.object.name)),
+                                                             times,
+                                                             [pose[bone.name] for pose in poses],
+                                                             'QUATERNION'))
+
+        if not do_object:
+            return channels
+        rotation_mode = self.object.rotation_mode
+        if self.config.use_quaternions or \
+           (self.config.convert_euler_rotations and rotation_mode not in ['QUATERNION', 'AXIS_ANGLE']):
+            rotation_mode = 'QUATERNION'
+        channels.extend(self.createTransformChannels(self.target,
+                                                     times,
+                                                     samples.select(samples.object[self.object], frame_range),
+                                                     rotation_mode,
+                                                     osgbake.getBoneCorrection(self.object)))
+        return channels
+
+    def createTransformChannels(self, target, times, matrices, rotation_mode, correction=None):
+        translate = Channel()
+        translate.setName("translate")
+        translate.type = "Vec3LinearChannel"
+        rotations = []
+        scale = Channel()
+        scale.setName("scale")
+        scale.type = "Vec3LinearChannel"
+
+        if rotation_mode == 'QUATERNION':
+            rotation = Channel()
+            rotation.setName("quaternion")
+            rotation.type = "QuatSphericalLinearChannel"
+            rotations.append(rotation)
+        elif rotation_mode == 'AXIS_ANGLE':
+            rotation = Channel()
+            rotation.setName("axis_angle")
+            rotation.type = "QuatSphericalLinearChannel"
+            rotations.append(rotation)
+        else:
+            for name in ["euler_x", "euler_y", "euler_z"]:
+                rotation = Channel()
+                rotation.setName(name)
+                rotation.type = "FloatLinearChannel"
+                rotations.append(rotation)
+
+        previous = None
+        for (time, matrix) in zip(times, matrices):
+            location, quaternion, scaling = matrix.decompose()
+            if correction is not None:
+                location += correction
+            # When scaling the exported result, we want to multiply only location values
+            location *= self.config.scale_factor
+            translate.keys.append([time, location.x, location.y, location.z])
+            scale.keys.append([time, scaling.x, scaling.y, scaling.z])
+            if rotation_mode == 'QUATERNION':
+                if previous is not None:
+                    quaternion.make_compatible(previous)
+                previous = quaternion
+                rotations[0].keys.append([time, quaternion.x, quaternion.y, quaternion.z, quaternion.w])
+            elif rotation_mode == 'AXIS_ANGLE':
+                axis, angle = quaternion.to_axis_angle()
+                rotations[0].keys.append([time, axis.x, axis.y, axis.z, angle])
+            else:
+                if previous is not None:
+                    euler = quaternion.to_euler(rotation_mode, previous)
+                else:
+                    euler = quaternion.to_euler(rotation_mode)
+                previous = euler
+                for i in range(3):
+                    rotations[i].keys.append([time, euler[i]])
+
+        channels = []
+        for channel in [translate] + rotations + [scale]:
+            channel.target = target
+            channel.keys = osganim.removeFlatKeys(channel.keys)
+            channels.append(channel)
+        return channels
+
+    def getFCurveIndex(self, action):
+        ''' Index the fcurves of an action once, it is queried for every bone and shape key '''
+        if action not in self.fcurve_indexes:
+            self.fcurve_indexes[action] = dict(((fcurve.data_path, fcurve.array_index), fcurve)
+                                               for fcurve in action.fcurves)
+        return self.fcurve_indexes[action]
+
     def getChannel(self, target, action, fps, data_path, array_indexes, osg_targetname):
-        times = []
-        duration = 0
-        fcurves = []
-
-        for array_index in array_indexes:
-            for fcurve in action.fcurves:
-                # Log("fcurves {} {} matches {} {} ".format(fcurve.data_path,
-                #                                                  fcurve.array_index,
-                #                                                  data_path,
-                #                                                  array_index))
-                if fcurve.data_path == data_path and fcurve.array_index == array_index:
-                    fcurves.append(fcurve)
-                    # Log("yes")
+        index = self.getFCurveIndex(action)
+        fcurves = [index[(data_path, array_index)] for array_index in array_indexes
+                   if (data_path, array_index) in index]
 
         if len(fcurves) == 0:
             return None
 
-        for fcurve in fcurves:
-            for keyframe in fcurve.keyframe_points:
-                if times.count(keyframe.co[0]) == 0:
-                    times.append(keyframe.co[0])
+        samples = [getKeyframeSamples(fcurve) for fcurve in fcurves]
+        times = set()
+        for keys in samples:
+            times.update(keys)
 
         if len(times) == 0:
             return None
@@ -1798,25 +2583,83 @@ class BlenderAnimationToAnimation(object):
         if len(array_indexes) == 4:
             channel.type = "QuatSphericalLinearChannel"
 
-        times.sort()
+        times = sorted(times)
+        columns = []
+        for (fcurve, keys) in zip(fcurves, samples):
+            column = self.sampleFCurve(fcurve, keys, times)
+            if fcurve.data_path.endswith("location"):
+                # When scaling the exported result, we want to multiply only object's location values
+                scale_factor = self.config.scale_factor
+                column = [value * scale_factor for value in column]
+            columns.append(column)
 
-        for time in times:
-            realtime = (time) / fps
-            # Log("time {} {} {}".format(time, realtime, fps))
+        for key in zip([time / fps for time in times], *columns):
+            channel.keys.append(list(key))
 
-            # realtime = time
-            if realtime > duration:
-                duration = realtime
+        return channel
 
-            value = [realtime]
-            for fcurve in fcurves:
-                if fcurve.data_path.endswith("location"):
-                    # When scaling the exported result, we want to multiply only object's location values
-                    value.append(fcurve.evaluate(time) * self.config.scale_factor)
-                else:
-                    value.append(fcurve.evaluate(time))
-            channel.keys.append(value)
+    def sampleFCurve(self, fcurve, keys, times):
+        if len(fcurve.modifiers) == 0:
+            # a curve goes through its keyframes whatever the interpolation,
+            # only the times keyed on other components need to be evaluated
+            return [keys[time] if time in keys else fcurve.evaluate(time) for time in times]
+        return [fcurve.evaluate(time) for time in times]
 
+    def getEulerRotationMode(self, prefix):
+        ''' Returns the euler rotation mode of the target, None if it does not use euler rotations '''
+        try:
+            rotation_mode = self.object.path_resolve(prefix + "rotation_mode")
+        except ValueError:
+            return None
+        return rotation_mode if rotation_mode in ["XYZ", "XZY", "YXZ", "YZX", "ZXY", "ZYX"] else None
+
+    def getEulerQuaternionChannel(self, target, action, fps, prefix, osg_targetname):
+        '''
+        Merge the rotation_euler fcurves into a quaternion channel sampled at their keys,
+        components without fcurve use the current rotation of the target
+        '''
+        rotation_mode = self.getEulerRotationMode(prefix)
+        if rotation_mode is None:
+            return None
+        rotation = self.object.path_resolve(prefix + "rotation_euler")
+
+        index = self.getFCurveIndex(action)
+        fcurves = [index.get((prefix + "rotation_euler", i)) for i in range(3)]
+        samples = [getKeyframeSamples(fcurve) if fcurve else {} for fcurve in fcurves]
+        times = set()
+        for keys in samples:
+            times.update(keys)
+        if len(times) == 0:
+            return None
+
+        def sampleColumns(times):
+            return [self.sampleFCurve(fcurves[i], samples[i], times) if fcurves[i] else [rotation[i]] * len(times)
+                    for i in range(3)]
+
+        times = sorted(times)
+        columns = sampleColumns(times)
+        # slerp takes the shortest way between two keys, so keys more than
+        # a quarter turn apart on an axis are subdivided
+        extra_times = []
+        for i in range(1, len(times)):
+            steps = int(max(abs(column[i] - column[i - 1]) for column in columns) / (math.pi / 2))
+            for step in range(1, steps + 1):
+                extra_times.append(times[i - 1] + (times[i] - times[i - 1]) * step / (steps + 1))
+        if extra_times:
+            times = sorted(times + extra_times)
+            columns = sampleColumns(times)
+
+        channel = Channel()
+        channel.target = osg_targetname if osg_targetname else target
+        channel.type = "QuatSphericalLinearChannel"
+        previous = None
+        for (time, x, y, z) in zip(times, *columns):
+            q = mathutils.Euler((x, y, z), rotation_mode).to_quaternion()
+            # stay in the hemisphere of the previous key so slerp takes the short path
+            if previous is not None and previous.dot(q) < 0.0:
+                q.negate()
+            previous = q
+            channel.keys.append([time / fps, q.x, q.y, q.z, q.w])
         return channel
 
     def exportActionsToKeyframeSplitRotationTranslationScale(self, target, action, fps, prefix, osg_targetname=''):
@@ -1827,17 +2670,27 @@ class BlenderAnimationToAnimation(object):
             translate.setName("translate")
             channels.append(translate)
 
-        eulerName = ["euler_x", "euler_y", "euler_z"]
-        for i in range(0, 3):
-            c = self.getChannel(target, action, fps, prefix + "rotation_euler", [i], osg_targetname)
-            if c:
-                c.setName(eulerName[i])
-                channels.append(c)
-
-        quaternion = self.getChannel(target, action, fps, prefix + "rotation_quaternion", [1, 2, 3, 0], osg_targetname)
-        if quaternion:
-            quaternion.setName("quaternion")
-            channels.append(quaternion)
+        # euler targets only get a quaternion stacked transform, their rotation comes from
+        # the euler fcurves and the rotation_quaternion ones are ignored like blender does
+        convert_euler = self.config.convert_euler_rotations and self.getEulerRotationMode(prefix) is not None
+        if convert_euler:
+            euler_quaternion = self.getEulerQuaternionChannel(target, action, fps, prefix, osg_targetname)
+            if euler_quaternion:
+                euler_quaternion.setName("quaternion")
+                channels.append(euler_quaternion)
+        else:
+            eulerName = ["euler_x", "euler_y", "euler_z"]
+            for i in range(0, 3):
+                c = self.getChannel(target, action, fps, prefix + "rotation_euler", [i], osg_targetname)
+                if c:
+                    c.setName(eulerName[i])
+                    channels.append(c)
+
+            quaternion = self.getChannel(target, action, fps, prefix + "rotation_quaternion", [1, 2, 3, 0],
+                                         osg_targetname)
+            if quaternion:
+                quaternion.setName("quaternion")
+                channels.append(quaternion)
 
         axis_angle = self.getChannel(target, action, fps, prefix + "rotation_axis_angle", [1, 2, 3, 0], osg_targetname)
         if axis_angle:
@@ -492,6 +492,8 @@ class Node(Object):
         self.cullingActive = "TRUE"
         self.stateset = None
         self.update_callbacks = []
+        # (center, radius) of the bounding sphere, in the parent coordinate frame
+        self.initial_bound = None
 
     def className(self):
         return "Node"
@@ -503,6 +505,15 @@ class Node(Object):
         output.write(self.encode("$}\n"))
 
     def serializeContent(self, output):
+        if self.initial_bound is not None:
+            center, radius = self.initial_bound
+            output.write(self.encode("$#InitialBound {\n"))
+            output.write(self.encode("$##Center %s %s %s\n" % (STRFLT(center[0]),
+                                                               STRFLT(center[1]),
+                                                               STRFLT(center[2]))))
+            output.write(self.encode("$##Radius %s\n" % STRFLT(radius)))
+            output.write(self.encode("$#}\n"))
+
         if len(self.update_callbacks) > 0:
             output.write(self.encode("$#UpdateCallback TRUE {\n"))
             for i in self.update_callbacks:
@@ -1184,7 +1195,7 @@ class Bone(MatrixTransform):
         # self.inverse_bind_matrix = Matrix().to_4x4().identity()
         self.bone_inv_bind_matrix_skeleton = Matrix().to_4x4()
 
-    def buildBoneChildren(self, use_pose=False, scale_factor=1.0, deform_only=False):
+    def buildBoneChildren(self, use_pose=False, scale_factor=1.0, deform_only=False, pose_matrices=None):
         if self.skeleton is None or self.bone is None:
             return
 
@@ -1194,13 +1205,17 @@ class Bone(MatrixTransform):
         update_callback.setName(self.name)
         self.update_callbacks.append(update_callback)
 
-        if use_pose:
+        if use_pose and pose_matrices is not None:
+            bone_matrix = pose_matrices[self.bone.name].copy()
+        elif use_pose:
             bone_matrix = self.skeleton.pose.bones[self.bone.name].matrix.copy()
         else:
             bone_matrix = self.bone.matrix_local.copy()        
 
         if self.parent:
-            if use_pose:
+            if use_pose and pose_matrices is not None:
+                parent_matrix = pose_matrices[self.bone.parent.name].copy()
+            elif use_pose:
                 parent_matrix = self.skeleton.pose.bones[self.bone.name].parent.matrix.copy()
             else:
                 parent_matrix = self.bone.parent.matrix_local.copy()
@@ -1228,7 +1243,7 @@ class Bone(MatrixTransform):
             else:
                 b = Bone(self.skeleton, boneChild, self)
                 self.children.append(b)
-                b.buildBoneChildren(use_pose, scale_factor, deform_only)
+                b.buildBoneChildren(use_pose, scale_factor, deform_only, pose_matrices)
 
     def getMatrixInArmatureSpace(self):
         return self.bone.matrix_local
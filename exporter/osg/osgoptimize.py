@@ -0,0 +1,621 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+from collections import OrderedDict
+from . import osglog
+from .osgobject import *
+
+Log = osglog.log
+
+# Number of vertices addressable with DrawElementsUShort
+MAX_USHORT_VERTICES = 65536
+
+PRIMITIVE_SIZES = {"GL_LINES": 2,
+                   "GL_TRIANGLES": 3,
+                   "GL_QUADS": 4}
+
+
+# GEOMETRY PARTITIONING
+# ---------------------
+def collectElements(geometry):
+    ''' Returns the primitives of a geometry as a list of (centroid, type, indexes) '''
+    vertexes = geometry.vertexes.getArray()
+    elements = []
+    for primitive in geometry.primitives:
+        n = PRIMITIVE_SIZES.get(primitive.type, 1)
+        indexes = primitive.indexes
+        for i in range(0, len(indexes) - n + 1, n):
+            element = tuple(indexes[i:i + n])
+            centroid = [sum(vertexes[v][axis] for v in element) / n for axis in range(3)]
+            elements.append((centroid, primitive.type, element))
+    return elements
+
+
+def countVertices(elements):
+    used = set()
+    for element in elements:
+        used.update(element[2])
+    return len(used)
+
+
+def getElementsBounds(elements):
+    bmin = [min(e[0][axis] for e in elements) for axis in range(3)]
+    bmax = [max(e[0][axis] for e in elements) for axis in range(3)]
+    return bmin, bmax
+
+
+def medianSplit(elements):
+    ''' Split elements in two halves along the longest axis of their centroids bounds '''
+    bmin, bmax = getElementsBounds(elements)
+    extent = [bmax[axis] - bmin[axis] for axis in range(3)]
+    axis = extent.index(max(extent))
+    elements = sorted(elements, key=lambda e: e[0][axis])
+    middle = len(elements) // 2
+    return [elements[:middle], elements[middle:]]
+
+
+def octreeSplit(elements):
+    ''' Split elements in the eight octants of their centroids bounds '''
+    bmin, bmax = getElementsBounds(elements)
+    center = [(bmin[axis] + bmax[axis]) * 0.5 for axis in range(3)]
+    octants = [[] for i in range(8)]
+    for element in elements:
+        centroid = element[0]
+        octant = int(centroid[0] > center[0]) | \
+            int(centroid[1] > center[1]) << 1 | \
+            int(centroid[2] > center[2]) << 2
+        octants[octant].append(element)
+    return octants
+
+
+def partitionElements(elements, fits, split=medianSplit):
+    '''
+    Recursively subdivide elements with the split function until
+    each chunk satisfies the fits predicate. Chunks are returned
+    in a depth first order so neighbour chunks stay close in space.
+    '''
+    chunks = []
+    stack = [elements]
+    while stack:
+        chunk = stack.pop()
+        if len(chunk) <= 1 or fits(chunk):
+            chunks.append(chunk)
+            continue
+        parts = [part for part in split(chunk) if part]
+        if len(parts) <= 1:
+            chunks.append(chunk)
+            continue
+        stack.extend(reversed(parts))
+    return chunks
+
+
+def buildGeometryFromElements(geometry, elements):
+    '''
+    Create a copy of geometry restricted to the given elements. Vertex attributes,
+    vertex groups (rig influences) and morph targets are remapped to the new indexes
+    '''
+    remap = {}
+    order = []
+    primitives = OrderedDict()
+    for primitive in geometry.primitives:
+        if primitive.type not in primitives:
+            draw_elements = DrawElements()
+            draw_elements.type = primitive.type
+            primitives[primitive.type] = draw_elements
+
+    for element in elements:
+        indexes = primitives[element[1]].indexes
+        for index in element[2]:
+            if index not in remap:
+                remap[index] = len(order)
+                order.append(index)
+            indexes.append(remap[index])
+
+    def remapArray(array):
+        return [array[index] for index in order]
+
+    piece = geometry.__class__()
+    Object.copyFrom(piece, geometry)
+    piece.stateset = geometry.stateset
+    piece.primitives = [p for p in primitives.values() if len(p.indexes) > 0]
+    piece.vertexes = VertexArray(array=remapArray(geometry.vertexes.getArray()))
+    if geometry.normals:
+        piece.normals = NormalArray(array=remapArray(geometry.normals.getArray()))
+    if geometry.colors:
+        piece.colors = ColorArray(array=remapArray(geometry.colors.getArray()))
+
+    piece.uvs = OrderedDict()
+    for name, uv in geometry.uvs.items():
+        texcoords = TexCoordArray(array=remapArray(uv.getArray()))
+        texcoords.index = uv.index
+        piece.uvs[name] = texcoords
+
+    if hasattr(geometry, "groups"):
+        piece.groups = {}
+        for name, group in geometry.groups.items():
+            influences = [(remap[index], weight) for (index, weight) in group.vertexes if index in remap]
+            if influences:
+                vg = VertexGroup()
+                vg.targetGroupName = group.targetGroupName
+                vg.vertexes = influences
+                piece.groups[name] = vg
+
+    if hasattr(geometry, "morphTargets"):
+        for target in geometry.morphTargets:
+            # keep the target name so that the morph channels drive every piece
+            morph = Geometry()
+            morph.name = target.name
+            morph.vertexes = VertexArray(array=remapArray(target.vertexes.getArray()))
+            morph.primitives = piece.primitives
+            if hasattr(target, "factor"):
+                morph.factor = target.factor
+            piece.morphTargets.append(morph)
+
+    return piece
+
+
+def splitGeometry(geometry, max_vertices=MAX_USHORT_VERTICES):
+    '''
+    Split a geometry having more vertices than max_vertices into spatially
+    coherent geometries so each of them can be drawn with 16 bits indexes
+    '''
+    if geometry.vertexes is None or len(geometry.vertexes.getArray()) <= max_vertices:
+        return [geometry]
+
+    elements = collectElements(geometry)
+    chunks = partitionElements(elements, lambda chunk: countVertices(chunk) <= max_vertices)
+    if len(chunks) <= 1:
+        return [geometry]
+
+    Log("Splitting geometry {} with {} vertices into {} geometries"
+        .format(geometry.name, len(geometry.vertexes.getArray()), len(chunks)))
+    return [buildGeometryFromElements(geometry, chunk) for chunk in chunks]
+
+
+def splitLargeGeometries(geometries, max_vertices=MAX_USHORT_VERTICES):
+    result = []
+    for geometry in geometries:
+        result.extend(splitGeometry(geometry, max_vertices))
+    return result
+
+
+def chunkGeode(geode, max_elements):
+    '''
+    Partition the drawables of a static geode into an octree of chunks holding
+    at most max_elements primitives. Each chunk becomes a Geode with one geometry
+    per source drawable, sharing its StateSet, so chunks can be culled separately
+    '''
+    elements = []
+    for drawable_index, drawable in enumerate(geode.drawables):
+        for (centroid, primitive_type, element) in collectElements(drawable):
+            elements.append((centroid, primitive_type, element, drawable_index))
+
+    if len(elements) <= max_elements:
+        return geode
+
+    chunks = partitionElements(elements, lambda chunk: len(chunk) <= max_elements, split=octreeSplit)
+    if len(chunks) <= 1:
+        return geode
+
+    Log("Chunking {} with {} primitives into {} chunks".format(geode.name, len(elements), len(chunks)))
+    group = Group()
+    group.setName(geode.name)
+    for chunk_index, chunk in enumerate(chunks):
+        per_drawable = OrderedDict()
+        for element in chunk:
+            per_drawable.setdefault(element[3], []).append(element)
+
+        chunk_geode = Geode()
+        chunk_geode.name = "{}_{}".format(geode.name, chunk_index)
+        for drawable_index in sorted(per_drawable.keys()):
+            chunk_geode.drawables.append(buildGeometryFromElements(geode.drawables[drawable_index],
+                                                                   per_drawable[drawable_index]))
+        group.children.append(chunk_geode)
+    return group
+
+
+# SCENE HIERARCHY
+# ---------------
+def isAnimatedSubgraph(node):
+    ''' Returns True if the subgraph is driven at runtime (animation, skinning, morphing or bones) '''
+    if isinstance(node, (Skeleton, Bone)):
+        return True
+    if len(getattr(node, "update_callbacks", [])) > 0:
+        return True
+    if isinstance(node, Geode):
+        for drawable in node.drawables:
+            if drawable.className() in ("RigGeometry", "MorphGeometry") or drawable.update_callbacks:
+                return True
+    if isinstance(node, Group):
+        for child in node.children:
+            if isAnimatedSubgraph(child):
+                return True
+    return False
+
+
+def mergeBounds(bounds_list):
+    bounds_list = [b for b in bounds_list if b is not None]
+    if not bounds_list:
+        return None
+    bmin = [min(b[0][axis] for b in bounds_list) for axis in range(3)]
+    bmax = [max(b[1][axis] for b in bounds_list) for axis in range(3)]
+    return (bmin, bmax)
+
+
+def transformBounds(bounds, matrix):
+    bmin, bmax = bounds
+    corners = []
+    for x in (bmin[0], bmax[0]):
+        for y in (bmin[1], bmax[1]):
+            for z in (bmin[2], bmax[2]):
+                v = matrix @ Vector((x, y, z))
+                corners.append((v, v))
+    return mergeBounds(corners)
+
+
+def getGeometryBounds(geometry, cache):
+    if geometry in cache:
+        return cache[geometry]
+    bounds = None
+    if geometry.vertexes is not None and len(geometry.vertexes.getArray()) > 0:
+        array = geometry.vertexes.getArray()
+        bounds = ([min(v[axis] for v in array) for axis in range(3)],
+                  [max(v[axis] for v in array) for axis in range(3)])
+    cache[geometry] = bounds
+    return bounds
+
+
+def computeBounds(node, matrix, cache):
+    ''' Returns the (min, max) box of a subgraph in the frame of matrix, or None if empty '''
+    if isinstance(node, MatrixTransform) and node.matrix is not None:
+        matrix = matrix @ node.matrix
+
+    bounds_list = []
+    if isinstance(node, Geode):
+        for drawable in node.drawables:
+            bounds = getGeometryBounds(drawable, cache)
+            if bounds is not None:
+                bounds_list.append(transformBounds(bounds, matrix))
+    if isinstance(node, LightSource):
+        position = matrix.to_translation()
+        bounds_list.append((position, position))
+    if isinstance(node, Group):
+        for child in node.children:
+            bounds_list.append(computeBounds(child, matrix, cache))
+    return mergeBounds(bounds_list)
+
+
+def setInitialBound(node, bounds):
+    if bounds is None:
+        return
+    bmin, bmax = bounds
+    center = [(bmin[axis] + bmax[axis]) * 0.5 for axis in range(3)]
+    radius = (Vector(bmax) - Vector(bmin)).length * 0.5
+    node.initial_bound = (center, radius)
+
+
+def buildBoundingVolume(elements, leaf_size):
+    group = Group()
+    if len(elements) <= leaf_size:
+        group.children = [element[2] for element in elements]
+    else:
+        group.children = [buildBoundingVolume(part, leaf_size) for part in medianSplit(elements)]
+    setInitialBound(group, mergeBounds([element[1] for element in elements]))
+    return group
+
+
+def buildSpatialHierarchy(root, leaf_size):
+    '''
+    Rebuild the children of root into a bounding volume hierarchy of groups
+    clustered by world space bounds. Animated, skinned and bone parented
+    subgraphs are kept in place as direct children of root
+    '''
+    kept = []
+    elements = []
+    cache = {}
+    identity = Matrix.Identity(4)
+    for child in root.children:
+        if isAnimatedSubgraph(child):
+            kept.append(child)
+            continue
+        bounds = computeBounds(child, identity, cache)
+        if bounds is None:
+            if isinstance(child, MatrixTransform):
+                position = child.matrix.to_translation()
+            else:
+                position = Vector((0, 0, 0))
+            bounds = (position, position)
+        setInitialBound(child, bounds)
+        center = [(bounds[0][axis] + bounds[1][axis]) * 0.5 for axis in range(3)]
+        elements.append((center, bounds, child))
+
+    if len(elements) <= leaf_size:
+        return
+
+    Log("Building spatial hierarchy for {} nodes, {} kept in place".format(len(elements), len(kept)))
+    root.children = kept + buildBoundingVolume(elements, leaf_size).children
+
+
+# STATIC BATCHING
+# ---------------
+def isBatchableGeode(geode):
+    if len(geode.update_callbacks) > 0 or geode.stateset is not None or geode.name == "collision":
+        return False
+    if getattr(geode, "armature_modifier", None) is not None:
+        return False
+    return len(geode.drawables) > 0 and all(d.className() == "Geometry" for d in geode.drawables)
+
+
+def collectBatchCandidates(node, matrix, candidates):
+    ''' Collect (parent, geode, world matrix) of the geodes not affected by any runtime update '''
+    if isinstance(node, (Skeleton, Bone)) or node.name == "collision" or len(node.update_callbacks) > 0:
+        return
+    if isinstance(node, MatrixTransform):
+        matrix = matrix @ node.matrix
+    if isinstance(node, Group):
+        for child in node.children:
+            if isinstance(child, Geode):
+                if isBatchableGeode(child):
+                    candidates.append((node, child, matrix))
+            else:
+                collectBatchCandidates(child, matrix, candidates)
+
+
+def getBatchKey(geometry):
+    ''' Geometries can only be merged if they share a stateset and vertex attributes layout '''
+    return (geometry.stateset,
+            geometry.normals is not None,
+            geometry.colors is not None,
+            tuple(geometry.uvs.keys()))
+
+
+def mergeGeometries(instances, name):
+    ''' Merge (geometry, world matrix) instances into a single geometry in world space '''
+    first = instances[0][0]
+    batch = Geometry()
+    batch.setName(name)
+    batch.stateset = first.stateset
+    batch.vertexes = VertexArray()
+    if first.normals is not None:
+        batch.normals = NormalArray()
+    if first.colors is not None:
+        batch.colors = ColorArray()
+    for key, uv in first.uvs.items():
+        batch.uvs[key] = TexCoordArray()
+        batch.uvs[key].index = uv.index
+
+    primitives = OrderedDict()
+    for (geometry, matrix) in instances:
+        offset = len(batch.vertexes.getArray())
+        for vertex in geometry.vertexes.getArray():
+            batch.vertexes.getArray().append(list(matrix @ Vector(vertex)))
+
+        if batch.normals is not None:
+            normal_matrix = matrix.to_3x3().inverted_safe().transposed()
+            for normal in geometry.normals.getArray():
+                batch.normals.getArray().append(list((normal_matrix @ Vector(normal)).normalized()))
+
+        if batch.colors is not None:
+            batch.colors.getArray().extend(geometry.colors.getArray())
+
+        for key in batch.uvs.keys():
+            batch.uvs[key].getArray().extend(geometry.uvs[key].getArray())
+
+        for primitive in geometry.primitives:
+            if primitive.type not in primitives:
+                draw_elements = DrawElements()
+                draw_elements.type = primitive.type
+                primitives[primitive.type] = draw_elements
+            primitives[primitive.type].indexes.extend(index + offset for index in primitive.indexes)
+
+    batch.primitives = list(primitives.values())
+    return batch
+
+
+def removeEmptyNodes(node, emptied, referenced, visited):
+    ''' Remove the plain nodes emptied by batching whose name is not referenced '''
+    if node in visited:
+        return
+    visited.add(node)
+    children = []
+    for child in node.children:
+        if isinstance(child, Group):
+            removeEmptyNodes(child, emptied, referenced, visited)
+            if child in emptied and not child.children and \
+                    isRemovable(child) and child.name not in referenced:
+                emptied.add(node)
+                continue
+        children.append(child)
+    # keep the list identity, the root children may be shared with the exporter items
+    node.children[:] = children
+
+
+def batchStaticGeodes(root, statesets, vertex_budget, referenced_names=()):
+    '''
+    Merge the static geodes sharing a registered StateSet into world space batches
+    of at most vertex_budget vertices. Geodes driven by update callbacks, rigs,
+    morphs, skeletons or named for collision are left untouched. Transforms left
+    empty are removed unless their name is in referenced_names
+    '''
+    statesets = set(statesets)
+    candidates = []
+    collectBatchCandidates(root, Matrix.Identity(4), candidates)
+
+    def isEligible(geometry):
+        return geometry.stateset in statesets and \
+            geometry.vertexes is not None and \
+            len(geometry.vertexes.getArray()) <= vertex_budget
+
+    counts = {}
+    eligible = []
+    for (parent, geode, matrix) in candidates:
+        if all(isEligible(geometry) for geometry in geode.drawables):
+            eligible.append((parent, geode, matrix))
+            for geometry in geode.drawables:
+                key = getBatchKey(geometry)
+                counts[key] = counts.get(key, 0) + 1
+
+    groups = OrderedDict()
+    emptied = set()
+    for (parent, geode, matrix) in eligible:
+        if any(counts[getBatchKey(geometry)] < 2 for geometry in geode.drawables):
+            continue
+        # geodes of shared subgraphs are collected once per instance
+        if geode in parent.children:
+            parent.children.remove(geode)
+            emptied.add(parent)
+        for geometry in geode.drawables:
+            position = matrix.to_translation()
+            groups.setdefault(getBatchKey(geometry), []).append((list(position),
+                                                                 len(geometry.vertexes.getArray()),
+                                                                 (geometry, matrix)))
+
+    for key, elements in groups.items():
+        stateset = key[0]
+        fits = lambda chunk: sum(element[1] for element in chunk) <= vertex_budget
+        batches = partitionElements(elements, fits)
+        Log("Batching {} geometries using stateset {} into {} geometries"
+            .format(len(elements), stateset.name, len(batches)))
+        for batch_index, batch in enumerate(batches):
+            name = "Batch_{}_{}".format(stateset.name, batch_index)
+            geode = Geode()
+            geode.setName(name)
+            geode.drawables.append(mergeGeometries([element[2] for element in batch], name))
+            root.children.append(geode)
+
+    removeEmptyNodes(root, emptied, set(referenced_names), set())
+
+
+# SCENE GRAPH OPTIMIZER
+# ---------------------
+def countReferences(node, counts):
+    ''' Count how many times each node and drawable is referenced in the graph '''
+    counts[node] = counts.get(node, 0) + 1
+    if counts[node] > 1:
+        return
+    for drawable in getattr(node, "drawables", []):
+        counts[drawable] = counts.get(drawable, 0) + 1
+    for child in getattr(node, "children", []):
+        countReferences(child, counts)
+
+
+def isRemovable(node):
+    ''' Plain groups and transforms carrying nothing but their children and matrix '''
+    return type(node) in (Group, MatrixTransform) and \
+        len(node.update_callbacks) == 0 and \
+        node.stateset is None and \
+        node.userdata is None and \
+        node.name != "collision"
+
+
+def isIdentity(matrix, epsilon=1e-6):
+    identity = Matrix.Identity(4)
+    for i in range(4):
+        for j in range(4):
+            if abs(matrix[i][j] - identity[i][j]) > epsilon:
+                return False
+    return True
+
+
+def flattenTransform(transform, counts):
+    ''' Bake the matrix of a transform into its unshared static geometries '''
+    if transform.matrix.determinant() <= 0 or not transform.children:
+        return False
+    for child in transform.children:
+        if not isinstance(child, Geode) or counts.get(child, 0) > 1 or not isBatchableGeode(child):
+            return False
+        for geometry in child.drawables:
+            if counts.get(geometry, 0) > 1 or geometry.vertexes is None:
+                return False
+
+    matrix = transform.matrix
+    normal_matrix = matrix.to_3x3().inverted_safe().transposed()
+    for geode in transform.children:
+        for geometry in geode.drawables:
+            vertexes = geometry.vertexes.getArray()
+            for i, vertex in enumerate(vertexes):
+                vertexes[i] = list(matrix @ Vector(vertex))
+            if geometry.normals is not None:
+                normals = geometry.normals.getArray()
+                for i, normal in enumerate(normals):
+                    normals[i] = list((normal_matrix @ Vector(normal)).normalized())
+    transform.matrix = Matrix.Identity(4)
+    return True
+
+
+def optimizeNode(node, counts, visited, flatten):
+    ''' Optimize a subgraph and return the list of nodes replacing it in its parent '''
+    if not isinstance(node, Group):
+        return [node]
+
+    if node not in visited:
+        visited.add(node)
+        children = []
+        for child in node.children:
+            children.extend(optimizeNode(child, counts, visited, flatten))
+        node.children = children
+
+    # shared nodes are kept as is to preserve the sharing
+    if not isRemovable(node) or counts.get(node, 0) > 1:
+        return [node]
+
+    if isinstance(node, MatrixTransform):
+        # fold chains of static transforms
+        while len(node.children) == 1 and \
+                type(node.children[0]) is MatrixTransform and \
+                isRemovable(node.children[0]) and \
+                counts.get(node.children[0], 0) == 1:
+            child = node.children[0]
+            node.matrix = node.matrix @ child.matrix
+            node.children = child.children
+            if node.name == "None":
+                node.name = child.name
+
+        if flatten:
+            flattenTransform(node, counts)
+
+        if isIdentity(node.matrix):
+            return node.children
+        if not node.children:
+            return []
+        return [node]
+
+    if len(node.children) <= 1:
+        return node.children
+    return [node]
+
+
+def optimizeSceneGraph(root, flatten=False):
+    '''
+    Remove identity transforms, fold chains of static transforms and remove
+    empty or single child groups, in the spirit of osgUtil::Optimizer.
+    Optionally static transforms are flattened into unshared geometries
+    '''
+    counts = {}
+    countReferences(root, counts)
+    before = len(counts)
+
+    visited = set([root])
+    children = []
+    for child in root.children:
+        children.extend(optimizeNode(child, counts, visited, flatten))
+    root.children = children
+
+    counts = {}
+    countReferences(root, counts)
+    Log("Scene graph optimizer removed {} nodes".format(before - len(counts)))
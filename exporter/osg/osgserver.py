@@ -0,0 +1,167 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# Export server: a background blender listening on a local socket for jobs
+# sent as one JSON object per line
+#   {"blend": "level.blend", "output": "out/level.osgt", "options": {"apply_modifiers": true}}
+# and answering one JSON object per line
+#   {"status": "ok", "output": "out/level.osgt", "timings": {...}, "items": 12, "animations": 1}
+# A {"command": "quit"} job stops the server.
+
+import bpy
+import json
+import os
+import socket
+import time
+import traceback
+from . import osgcache
+from . import osgconf
+from . import osgdata
+from . import osgobject
+
+# Config attributes a job can set. Options running executables (osgconv, viewer),
+# the conversion cache, whose files are unpickled, and attributes set by the server
+# itself are never accepted from a socket
+EXPORT_OPTIONS = ["author", "indent", "float_precision", "format_num", "anim_fps", "log",
+                  "selected", "relative_path", "texture_prefix", "only_visible", "export_anim",
+                  "apply_modifiers", "split_large_geometries", "chunk_large_meshes", "chunk_triangle_count",
+                  "spatial_hierarchy", "spatial_leaf_size", "static_batching", "batch_vertex_budget",
+                  "optimize_scene_graph", "flatten_static_transforms", "share_collection_instances",
+                  "share_object_instances", "shard_index", "shard_count", "bake_animations", "use_quaternions",
+                  "convert_euler_rotations", "bake_constraints", "bake_frame_step", "bake_to_channels",
+                  "selective_baking", "prune_constant_channels", "prune_stacked_transforms",
+                  "reduce_keyframes", "keyframe_position_tolerance", "keyframe_scale_tolerance",
+                  "keyframe_rotation_tolerance", "arm_rest", "arm_deform_only", "scale_factor",
+                  "export_all_scenes", "export_textures", "export_textkeys", "json_materials", "json_shaders"]
+
+LOOPBACK_HOSTS = ["127.0.0.1", "localhost"]
+
+
+def createConfig(job):
+    config = osgconf.Config()
+    for (name, value) in job.get("options", {}).items():
+        if name not in EXPORT_OPTIONS:
+            raise ValueError("unknown option {}".format(name))
+        setattr(config, name, value)
+    config.initFilePaths(job["output"])
+    config.scene = bpy.context.scene
+    return config
+
+
+class ExportServer(object):
+    '''
+    Run export jobs in the current blender process, keeping the interpreter,
+    the add-on modules and the conversion cache alive between jobs. The cache
+    directory only comes from the command line of the server
+    '''
+    def __init__(self, cache_dir="", cache_size=512):
+        self.geometry_cache = None
+        if cache_dir:
+            self.geometry_cache = osgcache.GeometryCache(os.path.abspath(cache_dir), cache_size * 1024 * 1024)
+
+    def run(self, job):
+        timings = {}
+        start = time.time()
+        blend = os.path.abspath(job["blend"])
+        # the file is opened again so jobs never see each other's changes
+        bpy.ops.wm.open_mainfile(filepath=blend)
+        timings["open"] = time.time() - start
+
+        start = time.time()
+        osgobject.Object.resetWriter()
+        config = createConfig(job)
+        exporter = osgdata.Export(config)
+        exporter.geometry_cache = self.geometry_cache
+        exporter.process()
+        timings["process"] = time.time() - start
+
+        start = time.time()
+        exporter.write()
+        timings["write"] = time.time() - start
+
+        return {"status": "ok",
+                "output": config.getFullName("osgt"),
+                "timings": timings,
+                "items": len(exporter.items),
+                "animations": len(exporter.animations)}
+
+    def handle(self, line):
+        try:
+            job = json.loads(line)
+            if job.get("command") == "quit":
+                return {"status": "quit"}
+            return self.run(job)
+        except Exception as e:
+            return {"status": "error",
+                    "error": str(e),
+                    "traceback": traceback.format_exc()}
+
+
+def isTcpAddress(address):
+    ''' host:port listens on TCP, anything else is a UNIX socket path '''
+    return not hasattr(socket, "AF_UNIX") or (address.count(":") == 1 and "/" not in address)
+
+
+def createServerSocket(address):
+    if isTcpAddress(address):
+        host, port = address.rsplit(":", 1)
+        host = host or "127.0.0.1"
+        # jobs write files anywhere the user can, so never listen beyond this machine
+        if host not in LOOPBACK_HOSTS:
+            raise ValueError("the export server only listens on loopback addresses, not {}".format(host))
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, int(port)))
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(address)
+    server.listen(1)
+    return server
+
+
+def serve(address, cache_dir="", cache_size=512):
+    ''' Answer the jobs of one client at a time until a quit job is received '''
+    export_server = ExportServer(cache_dir, cache_size)
+    server = createServerSocket(address)
+    print("export server listening on {}".format(address))
+    running = True
+    try:
+        while running:
+            connection, client = server.accept()
+            # a text stream both read and written drops its read buffer on writes
+            with connection, connection.makefile("r", encoding="utf-8") as reader, \
+                    connection.makefile("w", encoding="utf-8") as writer:
+                for line in reader:
+                    if not line.strip():
+                        continue
+                    result = export_server.handle(line)
+                    try:
+                        writer.write(json.dumps(result) + "\n")
+                        writer.flush()
+                    except OSError:
+                        # the client went away, wait for the next one
+                        break
+                    if result["status"] == "quit":
+                        running = False
+                        break
+    finally:
+        server.close()
+        if not isTcpAddress(address) and os.path.exists(address):
+            os.remove(address)
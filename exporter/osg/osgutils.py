@@ -23,6 +23,7 @@
 #  Aurélien Chatelain <chatelain.aurelien@gmail.com>
 
 
+import array
 import bpy
 import math
 from .osgobject import *
@@ -176,6 +177,25 @@ def hasNLATracks(blender_object):
         blender_object.animation_data.nla_tracks
 
 
+def getKeyframeSamples(fcurve):
+    ''' Returns {time: value} of the keyframes of an fcurve, read in a single call '''
+    co = array.array('f', [0]) * (len(fcurve.keyframe_points) * 2)
+    fcurve.keyframe_points.foreach_get('co', co)
+    return dict(zip(co[0::2], co[1::2]))
+
+
+def estimateExportCost(blender_object):
+    ''' Rough relative cost of exporting an object, used to balance sharded exports '''
+    cost = 1
+    if blender_object.type == 'MESH':
+        cost += len(blender_object.data.vertices) + len(blender_object.data.polygons)
+    if hasAction(blender_object) or hasNLATracks(blender_object):
+        # animations are sampled per frame and per bone
+        bones = len(blender_object.pose.bones) if blender_object.pose else 1
+        cost += 100 * bones
+    return cost
+
+
 def isDeform(bone):
     if bone.use_deform:
         return True
@@ -241,6 +261,106 @@ def isObjectMorphAction(action):
 
 # OBJECTS HELPERS
 # ---------------
+def getIDSignature(value):
+    ''' Identity of a datablock, linked libraries can hold datablocks of the same name '''
+    return (type(value).__name__, value.name_full, value.library.filepath if value.library else None)
+
+
+def dependsOnObjects(value):
+    ''' Datablocks whose evaluation depends on object transforms '''
+    return isinstance(value, (bpy.types.Object, bpy.types.Collection))
+
+
+def nodeTreeDependsOnObjects(node_tree, visited=None):
+    ''' Whether a node group, or one of the groups it nests, reads objects or collections '''
+    if visited is None:
+        visited = set()
+    if node_tree.name_full in visited:
+        return False
+    visited.add(node_tree.name_full)
+    for node in node_tree.nodes:
+        for socket in node.inputs:
+            if dependsOnObjects(getattr(socket, 'default_value', None)):
+                return True
+        for prop in node.bl_rna.properties:
+            if prop.type != 'POINTER':
+                continue
+            value = getattr(node, prop.identifier, None)
+            if dependsOnObjects(value):
+                return True
+            if isinstance(value, bpy.types.NodeTree) and nodeTreeDependsOnObjects(value, visited):
+                return True
+    return False
+
+
+def getHashableValue(value):
+    ''' Settings read from rna or ID properties as hashable values '''
+    if isinstance(value, (set, frozenset)):
+        # enum flags
+        return tuple(sorted(value))
+    if hasattr(value, 'to_dict'):
+        value = value.to_dict()
+    elif hasattr(value, 'to_list'):
+        value = value.to_list()
+    if isinstance(value, dict):
+        return tuple(sorted((key, getHashableValue(item)) for (key, item) in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(getHashableValue(item) for item in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def getModifierStackSignature(blender_object):
+    '''
+    Hashable description of the modifier settings and material slots of an object.
+    Objects sharing a mesh and a signature evaluate to the same mesh, modifiers
+    using objects, collections or non ID data (curve profiles, caches...) make
+    the signature unique
+    '''
+    signature = []
+    for modifier in blender_object.modifiers:
+        settings = [modifier.type]
+        for prop in modifier.bl_rna.properties:
+            if prop.identifier in ('rna_type', 'name') or prop.type == 'COLLECTION':
+                continue
+            value = getattr(modifier, prop.identifier, None)
+            if prop.type == 'POINTER':
+                if value is None:
+                    pass
+                elif dependsOnObjects(value) or not isinstance(value, bpy.types.ID):
+                    return (blender_object,)
+                elif isinstance(value, bpy.types.NodeTree) and nodeTreeDependsOnObjects(value):
+                    return (blender_object,)
+                else:
+                    value = getIDSignature(value)
+            elif getattr(prop, 'is_array', False):
+                value = tuple(value)
+            else:
+                value = getHashableValue(value)
+            settings.append((prop.identifier, value))
+        # geometry nodes inputs are stored as custom properties
+        for key in modifier.keys():
+            value = modifier[key]
+            if dependsOnObjects(value):
+                return (blender_object,)
+            if isinstance(value, bpy.types.ID):
+                value = getIDSignature(value)
+            else:
+                # vector and color inputs are ID property arrays, their repr has no values
+                value = getHashableValue(value)
+            settings.append((key, value))
+        signature.append(tuple(settings))
+
+    # modifiers name vertex groups, which belong to the object
+    signature.append(tuple(group.name for group in blender_object.vertex_groups))
+    signature.append(tuple(getIDSignature(slot.material) if slot.material else None
+                           for slot in blender_object.material_slots))
+    return tuple(signature)
+
+
 def getDeltaMatrixFromMatrix(parent, child):
     p = parent
     bi = p.copy()
@@ -296,6 +416,8 @@ def setArmaturesPosePosition(scene, pose_position, armatures=[]):
         if arm_data.pose_position != pose_position:
             arm_data.pose_position = pose_position
             modified.append(armature)
-    
-    bpy.context.view_layer.update()
+
+    # only evaluate the scene again when a pose position actually changed
+    if modified:
+        bpy.context.view_layer.update()
     return modified
@@ -0,0 +1,124 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import bpy
+import time
+from . import osglog
+from . import osgdata
+
+Log = osglog.log
+
+# Seconds without changes before the scene is exported again
+UPDATE_DELAY = 0.5
+
+
+class LiveExport(object):
+    '''
+    Export the scene again each time it changes. Changes patch the subtrees of the
+    changed objects into the previous export, skipping the whole graph passes
+    (batching, scene graph optimization, spatial hierarchy) which only run when the
+    blend file is saved. Conversions of unchanged datablocks are always kept
+    '''
+    def __init__(self, config):
+        self.config = config
+        self.exporter = None
+        self.changed = set()
+        self.exporting = False
+        self.scheduled = False
+        # bpy compares the registered callbacks by identity
+        self.update_handler = self.onDepsgraphUpdate
+        self.save_handler = self.onSave
+        self.timer = self.onTimer
+
+    def export(self, full=False):
+        start = time.time()
+        self.exporting = True
+        try:
+            changed = self.changed
+            self.changed = set()
+            if not full and self.exporter is not None and self.exporter.patch(changed):
+                self.exporter.write()
+            else:
+                exporter = osgdata.Export(self.config)
+                exporter.graph_passes = full
+                if self.exporter is not None:
+                    exporter.retainConversions(self.exporter, changed)
+                exporter.process()
+                exporter.write()
+                self.exporter = exporter
+        except Exception:
+            # a failed patch leaves a partial graph, start from a full export next time
+            self.exporter = None
+            raise
+        finally:
+            # frame changes and pose positions restored by the export tag datablocks whose
+            # update would come on the next event loop and schedule another export,
+            # evaluate them now while the updates are ignored
+            bpy.context.view_layer.update()
+            self.exporting = False
+        Log("live export of {} done in {:.2f}s".format(self.config.getFullName("osgt"), time.time() - start))
+
+    def onDepsgraphUpdate(self, scene, depsgraph):
+        # the export itself changes frames and pose positions
+        if self.exporting or scene != self.config.scene:
+            return
+        for update in depsgraph.updates:
+            data = update.id.original
+            self.changed.add(data)
+            if isinstance(data, bpy.types.Object) and update.is_updated_geometry and data.data is not None:
+                self.changed.add(data.data)
+            if isinstance(data, bpy.types.Key) and data.user is not None:
+                self.changed.add(data.user)
+        if not self.scheduled:
+            self.scheduled = True
+            bpy.app.timers.register(self.timer, first_interval=UPDATE_DELAY)
+
+    def onTimer(self):
+        self.scheduled = False
+        self.export()
+        return None
+
+    def onSave(self, *args):
+        if not self.exporting:
+            self.export(full=True)
+
+
+live_export = None
+
+
+def startLiveExport(config):
+    ''' Export the scene and export it again on each change until stopLiveExport '''
+    global live_export
+    stopLiveExport()
+    live_export = LiveExport(config)
+    live_export.export()
+    bpy.app.handlers.depsgraph_update_post.append(live_export.update_handler)
+    bpy.app.handlers.save_post.append(live_export.save_handler)
+
+
+def stopLiveExport():
+    global live_export
+    if live_export is None:
+        return
+    if live_export.update_handler in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(live_export.update_handler)
+    if live_export.save_handler in bpy.app.handlers.save_post:
+        bpy.app.handlers.save_post.remove(live_export.save_handler)
+    if bpy.app.timers.is_registered(live_export.timer):
+        bpy.app.timers.unregister(live_export.timer)
+    live_export = None
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- python-indent: 4; mode: python -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+'''
+Export many blend files with a pool of background blender processes.
+
+The manifest is a JSON file:
+  {"options": {"apply_modifiers": true},
+   "jobs": [{"blend": "props/crate.blend", "output": "out/crate.osgt"},
+            {"blend": "levels/town.blend", "output": "out/town.osgt", "options": {"export_anim": false}}]}
+Options are exporter Config attributes, job options override the global ones.
+Each worker is an export server (see osg/osgserver.py) kept alive between jobs.
+'''
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import queue
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+EXPORTER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "exporter")
+SERVER_EXPR = "import sys; sys.path.insert(0, {!r}); import osg; osg.main()"
+STARTUP_TIMEOUT = 120
+JOB_TIMEOUT = 3600
+
+
+def hashFile(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def getExporterVersion(exporter_dir):
+    ''' Hash of the exporter sources, any change to the exporter invalidates the previous runs '''
+    digest = hashlib.sha1()
+    for path in sorted(glob.glob(os.path.join(exporter_dir, "osg", "*.py"))):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def loadManifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for entry in manifest["jobs"]:
+        options = dict(manifest.get("options", {}))
+        options.update(entry.get("options", {}))
+        jobs.append({"blend": os.path.join(base, entry["blend"]),
+                     "output": os.path.join(base, entry["output"]),
+                     "options": options})
+    return jobs
+
+
+def getJobKey(job, exporter_version):
+    ''' Identify a job by its input content, the exporter sources and its options '''
+    return hashlib.sha1(json.dumps([hashFile(job["blend"]),
+                                    exporter_version,
+                                    job["options"]], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class BlenderWorker(object):
+    ''' A background blender running the export server '''
+    def __init__(self, blender, index, directory, cache_dir=""):
+        self.blender = blender
+        self.cache_dir = cache_dir
+        if hasattr(socket, "AF_UNIX"):
+            self.address = os.path.join(directory, "worker{}.sock".format(index))
+        else:
+            probe = socket.socket()
+            probe.bind(("127.0.0.1", 0))
+            self.address = "127.0.0.1:{}".format(probe.getsockname()[1])
+            probe.close()
+        self.process = None
+        self.connection = None
+        self.reader = None
+
+    def connect(self):
+        if not hasattr(socket, "AF_UNIX"):
+            host, port = self.address.rsplit(":", 1)
+            return socket.create_connection((host, int(port)))
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self.address)
+        return connection
+
+    def start(self):
+        env = dict(os.environ)
+        env["BlenderExporter"] = os.path.abspath(EXPORTER_DIR)
+        arguments = [self.blender, "--background", "--factory-startup",
+                     "--python-expr", SERVER_EXPR.format(os.path.abspath(EXPORTER_DIR)),
+                     "--", "--serve={}".format(self.address)]
+        # jobs can't set the conversion cache, the server is started with it
+        if self.cache_dir:
+            arguments.append("--cache-dir={}".format(os.path.abspath(self.cache_dir)))
+        self.process = subprocess.Popen(arguments, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + STARTUP_TIMEOUT
+        while self.connection is None:
+            if self.process.poll() is not None or time.time() > deadline:
+                raise RuntimeError("blender worker {} failed to start".format(self.address))
+            try:
+                self.connection = self.connect()
+            except OSError:
+                time.sleep(0.2)
+        self.reader = self.connection.makefile("r", encoding="utf-8")
+
+    def run(self, job, timeout=None):
+        if self.connection is None:
+            self.start()
+        try:
+            self.connection.settimeout(timeout)
+            self.connection.sendall((json.dumps(job) + "\n").encode('utf-8'))
+            line = self.reader.readline()
+        except socket.timeout:
+            # blender hangs on this file, a new worker takes the next job
+            self.kill()
+            return {"status": "error", "error": "export timed out after {}s".format(timeout)}
+        except OSError:
+            line = ""
+        if not line:
+            # blender crashed on this file, a new worker takes the next job
+            self.stop()
+            return {"status": "error", "error": "blender worker exited"}
+        return json.loads(line)
+
+    def kill(self):
+        if self.connection is not None:
+            self.reader.close()
+            self.connection.close()
+            self.connection = None
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def stop(self):
+        if self.connection is not None:
+            try:
+                self.connection.sendall(b'{"command": "quit"}\n')
+                self.reader.readline()
+            except OSError:
+                pass
+            self.reader.close()
+            self.connection.close()
+            self.connection = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+
+def runBatch(jobs, blender, workers, state_path, force=False, cache_dir="", timeout=JOB_TIMEOUT):
+    '''
+    Export the jobs, largest blend files first, returns the report entries.
+    Jobs whose blend file can't be read and jobs running longer than timeout
+    seconds are reported as failed
+    '''
+    exporter_version = getExporterVersion(EXPORTER_DIR)
+    state = {}
+    if os.path.exists(state_path) and not force:
+        with open(state_path) as f:
+            state = json.load(f)
+
+    report = []
+    sized = []
+    for job in jobs:
+        try:
+            sized.append((os.path.getsize(job["blend"]), job, getJobKey(job, exporter_version)))
+        except OSError as e:
+            report.append({"blend": job["blend"], "output": job["output"], "status": "error",
+                           "error": str(e), "duration": 0})
+            state.pop(job["output"], None)
+            print("error {} ({})".format(job["blend"], e))
+
+    pending = queue.Queue()
+    for (size, job, key) in sorted(sized, key=lambda item: item[0], reverse=True):
+        if state.get(job["output"]) == key and os.path.exists(job["output"]):
+            report.append({"blend": job["blend"], "output": job["output"], "status": "skipped", "duration": 0})
+            continue
+        pending.put((job, key))
+
+    lock = threading.Lock()
+
+    def work(worker):
+        try:
+            while True:
+                try:
+                    (job, key) = pending.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.time()
+                try:
+                    result = worker.run(job, timeout)
+                except Exception as e:
+                    result = {"status": "error", "error": str(e)}
+                entry = {"blend": job["blend"],
+                         "output": job["output"],
+                         "status": result["status"],
+                         "duration": time.time() - start}
+                if result["status"] == "error":
+                    entry["error"] = result.get("error")
+                    entry["traceback"] = result.get("traceback")
+                with lock:
+                    report.append(entry)
+                    if result["status"] == "ok":
+                        state[job["output"]] = key
+                    else:
+                        state.pop(job["output"], None)
+                print("{status} {blend} ({duration:.1f}s)".format(**entry))
+        finally:
+            worker.stop()
+
+    directory = tempfile.mkdtemp(prefix="osgbatch")
+    threads = [threading.Thread(target=work, args=(BlenderWorker(blender, i, directory, cache_dir),))
+               for i in range(min(workers, pending.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with open(state_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the blend files listed in a manifest")
+    parser.add_argument("manifest", help="JSON manifest of the jobs")
+    parser.add_argument("-j", "--jobs", dest="workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of blender processes running in parallel")
+    parser.add_argument("--blender", default="blender", help="Path to the blender executable")
+    parser.add_argument("--state", default=None,
+                        help="File remembering the successful exports (default: next to the manifest)")
+    parser.add_argument("--report", default=None, help="Write the JSON summary report to this file")
+    parser.add_argument("--timeout", type=float, default=JOB_TIMEOUT,
+                        help="Seconds after which a job is failed and its blender process killed")
+    parser.add_argument("--cache-dir", default="", help="Conversion cache directory shared by the workers")
+    parser.add_argument("-f", "--force", action="store_true", default=False,
+                        help="Export every job even if unchanged since the last run")
+    args = parser.parse_args()
+
+    state_path = args.state or os.path.splitext(args.manifest)[0] + ".state.json"
+    start = time.time()
+    report = runBatch(loadManifest(args.manifest), args.blender, args.workers, state_path, args.force,
+                      args.cache_dir, args.timeout)
+    failures = [entry for entry in report if entry["status"] == "error"]
+    summary = {"duration": time.time() - start,
+               "exported": len([entry for entry in report if entry["status"] == "ok"]),
+               "skipped": len([entry for entry in report if entry["status"] == "skipped"]),
+               "failed": len(failures),
+               "jobs": sorted(report, key=lambda entry: entry["duration"], reverse=True)}
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(summary, f, indent=2)
+    print("{exported} exported, {skipped} skipped, {failed} failed in {duration:.1f}s".format(**summary))
+    for entry in failures:
+        print("FAILED {}: {}".format(entry["blend"], entry.get("error")))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- python-indent: 4; mode: python -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+'''
+Export one scene with several blender processes and merge the results.
+
+Each process exports a shard of the top level objects (see Export.selectShardRoots)
+to its own .osgt file, the shards are then merged into a single scene:
+UniqueIDs and ArrayIDs are renumbered, identical StateSets are written once
+and the animations of the same name are merged into one.
+'''
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from osgbatch import BlenderWorker
+
+UNIQUE_ID = re.compile(r"^(\s*UniqueID )(\d+)$")
+ARRAY_ID = re.compile(r"^(\s*Array TRUE ArrayID )(\d+)(.*)$")
+COUNTED_BLOCK = re.compile(r"^(\s*)(Children|Animations|Channels) (\d+) \{$")
+# osg::Object and osg::Node properties written before the UpdateCallback
+NODE_PROPERTIES_BEFORE_CALLBACK = ["UniqueID", "Name", "DataVariance", "UserData", "InitialBound",
+                                   "ComputeBoundingSphereCallback"]
+
+
+# OSGT PARSING
+# ------------
+class Block(object):
+    ''' A "header {" ... "}" block of an ascii osg file, items are lines or blocks '''
+    def __init__(self, header, footer="}"):
+        self.header = header
+        self.footer = footer
+        self.items = []
+
+    def blocks(self):
+        return [item for item in self.items if isinstance(item, Block)]
+
+    def find(self, name):
+        for block in self.blocks():
+            if block.header.strip().startswith(name):
+                return block
+        return None
+
+    def walk(self):
+        yield self
+        for block in self.blocks():
+            for child in block.walk():
+                yield child
+
+    def lines(self):
+        yield self.header
+        for item in self.items:
+            if isinstance(item, Block):
+                for line in item.lines():
+                    yield line
+            else:
+                yield item
+        yield self.footer
+
+
+def parseOsgt(text):
+    ''' Returns (header lines, top level blocks) of an ascii osg file '''
+    header = []
+    blocks = []
+    stack = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.endswith("{"):
+            block = Block(line)
+            if stack:
+                stack[-1].items.append(block)
+            else:
+                blocks.append(block)
+            stack.append(block)
+        elif stripped == "}" and stack:
+            stack.pop().footer = line
+        elif stack:
+            stack[-1].items.append(line)
+        elif stripped.startswith("#"):
+            header.append(line)
+    return header, blocks
+
+
+def renumber(root, unique_offset, array_offset):
+    ''' Offset the ids of a shard, returns the next free (UniqueID, ArrayID) '''
+    next_unique = unique_offset
+    next_array = array_offset
+    for block in root.walk():
+        # arrays written in full are block headers, references are plain lines
+        match = ARRAY_ID.match(block.header)
+        if match:
+            value = int(match.group(2)) + array_offset
+            block.header = "{}{}{}".format(match.group(1), value, match.group(3))
+            next_array = max(next_array, value + 1)
+        for (index, item) in enumerate(block.items):
+            if isinstance(item, Block):
+                continue
+            match = UNIQUE_ID.match(item)
+            if match:
+                value = int(match.group(2)) + unique_offset
+                block.items[index] = "{}{}".format(match.group(1), value)
+                next_unique = max(next_unique, value + 1)
+                continue
+            match = ARRAY_ID.match(item)
+            if match:
+                value = int(match.group(2)) + array_offset
+                block.items[index] = "{}{}{}".format(match.group(1), value, match.group(3))
+                next_array = max(next_array, value + 1)
+    return next_unique, next_array
+
+
+def getUniqueID(block):
+    for item in block.items:
+        if not isinstance(item, Block):
+            match = UNIQUE_ID.match(item)
+            if match:
+                return int(match.group(2))
+    return None
+
+
+def isReference(block):
+    ''' Objects written before are only referenced by their UniqueID '''
+    return len(block.items) == 1 and getUniqueID(block) is not None
+
+
+def remapReferences(root, remap):
+    for block in root.walk():
+        if isReference(block) and getUniqueID(block) in remap:
+            unique_id = getUniqueID(block)
+            block.items[0] = block.items[0].replace(str(unique_id), str(remap[unique_id]))
+
+
+def getDefinitionIDs(root):
+    ''' UniqueIDs of the objects written in full in a block, in file order '''
+    return [getUniqueID(block) for block in root.walk()
+            if not isReference(block) and getUniqueID(block) is not None]
+
+
+def getStateSetKey(block):
+    ''' Content of a block without the UniqueIDs of its definitions, references keep theirs '''
+    lines = [block.header.strip()]
+    for item in block.items:
+        if isinstance(item, Block):
+            if isReference(item):
+                lines.extend(line.strip() for line in item.lines())
+            else:
+                lines.extend(getStateSetKey(item))
+        elif not UNIQUE_ID.match(item):
+            lines.append(item.strip())
+    lines.append(block.footer.strip())
+    return lines
+
+
+def deduplicateStateSets(root, statesets):
+    '''
+    Replace the StateSets already written by a previous shard with references,
+    statesets maps the content of a StateSet without its ids to the UniqueIDs
+    of the StateSet and of the textures and attributes defined inside it
+    '''
+    remap = {}
+    for block in root.walk():
+        for (index, item) in enumerate(block.items):
+            if not isinstance(item, Block):
+                continue
+            if isReference(item):
+                remapReferences(item, remap)
+                continue
+            if item.header.strip() != "osg::StateSet {":
+                continue
+            # the textures it uses may have been defined by a dropped StateSet
+            remapReferences(item, remap)
+            key = "\n".join(getStateSetKey(item))
+            if key in statesets:
+                # the definitions nested in the dropped block map to the surviving ones
+                remap.update(zip(getDefinitionIDs(item), statesets[key]))
+                reference = Block(item.header, item.footer)
+                indent = item.items[0][:len(item.items[0]) - len(item.items[0].lstrip())]
+                reference.items.append("{}UniqueID {}".format(indent, statesets[key][0]))
+                block.items[index] = reference
+            else:
+                statesets[key] = getDefinitionIDs(item)
+
+
+def setCount(block, count):
+    match = COUNTED_BLOCK.match(block.header)
+    block.header = "{}{} {} {{".format(match.group(1), match.group(2), count)
+
+
+def mergeShards(texts):
+    ''' Merge the osgt texts of the shards into a single scene '''
+    merged_header = None
+    merged_root = None
+    manager = None
+    animations = {}
+    statesets = {}
+    unique_offset = 0
+    array_offset = 0
+    for text in texts:
+        header, blocks = parseOsgt(text)
+        if not blocks:
+            continue
+        root = blocks[0]
+        unique_offset, array_offset = renumber(root, unique_offset, array_offset)
+        deduplicateStateSets(root, statesets)
+
+        if merged_root is None:
+            merged_header = header
+            merged_root = root
+            if merged_root.find("Children") is None:
+                children = Block("  Children 0 {", "  }")
+                merged_root.items.append(children)
+        else:
+            children = root.find("Children")
+            if children is not None:
+                merged_children = merged_root.find("Children")
+                merged_children.items.extend(children.blocks())
+
+        callback = root.find("UpdateCallback")
+        shard_manager = callback.find("osgAnimation::BasicAnimationManager") if callback else None
+        if shard_manager is None:
+            continue
+        if manager is None:
+            # the first animation manager found receives the others
+            manager = shard_manager
+            if root is not merged_root:
+                insertUpdateCallback(merged_root, callback)
+            for animation in manager.find("Animations").blocks():
+                animations[animationName(animation)] = animation
+            continue
+        for animation in shard_manager.find("Animations").blocks():
+            name = animationName(animation)
+            if name in animations:
+                channels = animations[name].find("Channels")
+                channels.items.extend(animation.find("Channels").blocks())
+                setCount(channels, len(channels.blocks()))
+            else:
+                animations[name] = animation
+                manager.find("Animations").items.append(animation)
+
+    if merged_root is None:
+        return ""
+    setCount(merged_root.find("Children"), len(merged_root.find("Children").blocks()))
+    if manager is not None:
+        setCount(manager.find("Animations"), len(manager.find("Animations").blocks()))
+    return "\n".join(merged_header) + "\n\n" + "\n".join(merged_root.lines()) + "\n"
+
+
+def insertUpdateCallback(root, callback):
+    ''' The reader expects the UpdateCallback before the other Node properties like the StateSet '''
+    position = 0
+    for (index, item) in enumerate(root.items):
+        line = item.header if isinstance(item, Block) else item
+        if line.split() and line.split()[0] in NODE_PROPERTIES_BEFORE_CALLBACK:
+            position = index + 1
+    root.items.insert(position, callback)
+
+
+def animationName(animation):
+    for item in animation.items:
+        if not isinstance(item, Block) and item.strip().startswith("Name "):
+            return item.strip()
+    return None
+
+
+# DRIVER
+# ------
+def exportSharded(blend, output, shards, blender, options):
+    ''' Export blend into output using one blender process per shard '''
+    directory = tempfile.mkdtemp(prefix="osgshard")
+    base = os.path.splitext(os.path.abspath(output))[0]
+    results = [None] * shards
+
+    def work(index):
+        worker = BlenderWorker(blender, index, directory)
+        job_options = dict(options)
+        job_options["shard_index"] = index
+        job_options["shard_count"] = shards
+        try:
+            results[index] = worker.run({"blend": os.path.abspath(blend),
+                                         "output": "{}_shard{}.osgt".format(base, index),
+                                         "options": job_options})
+        except Exception as e:
+            results[index] = {"status": "error", "error": str(e)}
+        finally:
+            worker.stop()
+
+    threads = [threading.Thread(target=work, args=(index,)) for index in range(shards)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    failures = [result for result in results if result["status"] != "ok"]
+    if failures:
+        raise RuntimeError("; ".join(result.get("error", "") for result in failures))
+
+    texts = []
+    for result in results:
+        # a shard without any object writes no file
+        if not os.path.exists(result["output"]):
+            continue
+        with open(result["output"], encoding="utf-8") as f:
+            texts.append(f.read())
+        os.remove(result["output"])
+    with open(output, "w", encoding="utf-8") as f:
+        f.write(mergeShards(texts))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a scene with several blender processes")
+    parser.add_argument("blend", help="Blend file to export")
+    parser.add_argument("output", help="Merged .osgt file")
+    parser.add_argument("-j", "--shards", type=int, default=os.cpu_count() or 1,
+                        help="Number of blender processes")
+    parser.add_argument("--blender", default="blender", help="Path to the blender executable")
+    parser.add_argument("--options", default="{}", help="Exporter Config attributes as a JSON object")
+    args = parser.parse_args()
+
+    start = time.time()
+    results = exportSharded(args.blend, args.output, args.shards, args.blender, json.loads(args.options))
+    for (index, result) in enumerate(results):
+        print("shard {}: {}".format(index, result["timings"]))
+    print("{} exported in {:.1f}s".format(args.output, time.time() - start))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())